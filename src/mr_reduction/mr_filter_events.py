@@ -3,6 +3,7 @@
     Filter MR data and separate cross-section for compatibility with legacy software.
 """
 from __future__ import (absolute_import, division, print_function)
+import os
 import sys
 import logging
 
@@ -49,10 +50,12 @@ def filter_cross_sections(file_path, events=True, histo=False):
     """
     cross_sections = {}
     cross_sections_histo = {}
+    # Set MR_TMPDIR to redirect the filtered files, e.g. to /dev/shm
+    tmpdir = os.environ.get("MR_TMPDIR", "/tmp")
 
     xs_list = api.MRFilterCrossSections(file_path, PolState=POL_STATE, AnaState=ANA_STATE, PolVeto=POL_VETO, AnaVeto=ANA_VETO)
 
-    if len(xs_list)>0:
+    if histo and len(xs_list)>0:
         tof_min, tof_max = get_tof_range(xs_list[0])
 
     for workspace in xs_list:
@@ -65,16 +68,16 @@ def filter_cross_sections(file_path, events=True, histo=False):
             logging.warn("No events in %s", entry)
             continue
 
-        run_number = workspace.getRunNumber()
+        base = f"filtered_{workspace.getRunNumber()}_{entry}"
         if events:
-            events_file = "/tmp/filtered_%s_%s_%s.nxs" % (run_number, entry, "events")
+            events_file = os.path.join(tmpdir, f"{base}_events.nxs")
             api.SaveNexus(InputWorkspace=workspace, Filename=events_file, Title='entry_%s' % entry)
             cross_sections['entry-%s' % entry] = events_file
         if histo:
             #tof_min = workspace.getTofMin()
             #tof_max = workspace.getTofMax()
             ws_binned = api.Rebin(InputWorkspace=workspace, Params="%s, %s, %s" % (tof_min, TOF_BIN, tof_max), PreserveEvents=False)
-            histo_file = "/tmp/filtered_%s_%s_%s.nxs" % (run_number, entry, "histo")
+            histo_file = os.path.join(tmpdir, f"{base}_histo.nxs")
             api.SaveNexus(InputWorkspace=ws_binned, Filename=histo_file, Title='entry_%s' % entry)
             cross_sections_histo['entry-%s' % entry] = histo_file
 
@@ -98,6 +101,7 @@ def _filter_cross_sections(file_path, events=True, histo=False):
               'Off_On': 31,
               'On_On': 63}
     cross_sections = {}
+    tmpdir = os.environ.get("MR_TMPDIR", "/tmp")
     workspace = api.LoadEventNexus(Filename=file_path, OutputWorkspace="raw_events")
 
     for pol_state in states:
@@ -106,7 +110,7 @@ def _filter_cross_sections(file_path, events=True, histo=False):
                                        MinimumValue=states[pol_state],
                                        MaximumValue=states[pol_state], LogBoundary='Left')
 
-            events_file = "/tmp/filtered_%s_%s.nxs" % (pol_state, "events")
+            events_file = os.path.join(tmpdir, f"filtered_{pol_state}_events.nxs")
             api.SaveNexus(InputWorkspace=_ws, Filename=events_file, Title='entry_%s' % pol_state)
             cross_sections['entry-%s' % pol_state] = events_file
         except:
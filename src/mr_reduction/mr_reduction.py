@@ -4,6 +4,7 @@ Reduction for MR
 """
 
 # standard imports
+import numbers
 import os
 import sys
 import time
@@ -27,7 +28,12 @@ from mantid.simpleapi import (
 # mr_reduction imports
 from mr_reduction.data_info import DataInfo
 from mr_reduction.mr_direct_beam_finder import DirectBeamFinder
-from mr_reduction.reflectivity_merge import combined_catalog_info, combined_curves, plot_combined
+from mr_reduction.reflectivity_merge import (
+    combined_catalog_info,
+    combined_curves,
+    find_autoreduced_files,
+    plot_combined,
+)
 from mr_reduction.reflectivity_output import write_reflectivity
 from mr_reduction.runsample import RunSampleNumber
 from mr_reduction.script_output import write_partial_script
@@ -116,11 +122,13 @@ class ReductionProcess:
         live
         """
 
-        try:
-            int(data_run)
+        if isinstance(data_run, numbers.Integral) or (isinstance(data_run, str) and data_run.isdecimal()):
             self.run_number: Optional[int] = int(data_run)
             self.file_path = "REF_M_%s" % data_run
-        except:  # noqa E722
+        else:
+            # data_run may be None when the events are passed as data_ws, e.g. in live reduction
+            if not isinstance(data_run, str) and data_ws is None:
+                logger.error("Expected a run number or a file path, got %s" % repr(data_run))
             self.run_number = None
             self.file_path = data_run
         self.data_ws = data_ws
@@ -155,7 +163,8 @@ class ReductionProcess:
         self.script = ""
         self.logfile = None
         if debug:
-            self.logfile = open(os.path.join(GLOBAL_AR_DIR, "MR_live.log"), "a")
+            # Line-buffered, so the log is written line by line even if the reduction hangs or is killed
+            self.logfile = open(os.path.join(GLOBAL_AR_DIR, "MR_live.log"), "a", buffering=1)
         self.plot_2d = plot_2d
 
     def log(self, msg):
@@ -250,9 +259,9 @@ class ReductionProcess:
         Perform the reduction
         """
         self.log("\n\n---------- %s" % time.ctime())
-        # Load cross-sections
+        # Load cross-sections. MRFilterCrossSections filters the events already loaded, and is given the
+        # file name only when the events come from a file, for its handling of legacy files and for the history
         _filename = None if self.data_ws is not None else self.file_path
-        # if self.data_ws is not None and self.use_slow_flipper_log:
         if self.data_ws is None:
             self.data_ws = LoadEventNexus(Filename=self.file_path, OutputWorkspace="raw_events")
         self.run_number = int(self.data_ws.getRunNumber())
@@ -267,7 +276,7 @@ class ReductionProcess:
                 AnaState=self.ana_state,
                 PolVeto=self.pol_veto,
                 AnaVeto=self.ana_veto,
-                CrossSectionWorkspaces="%s" % self.data_ws.getRunNumber(),
+                CrossSectionWorkspaces="%s" % self.run_number,
             )
             # If we have no cross section info, treat the data as unpolarized and use Off_Off as the label.
             for ws in _xs_list:
@@ -286,8 +295,13 @@ class ReductionProcess:
         ref_plot = None
         try:
             run_sample_number = str(RunSampleNumber(self.run_number, self.sample_number))
+            # list the autoreduced files once, for both stitching and plotting
+            autoreduce_index = find_autoreduced_files(self.ipts, self.output_dir)
             matched_runs, scaling_factors, outputs = combined_curves(
-                run=run_sample_number, ipts=self.ipts, output_dir=self.output_dir
+                run=run_sample_number,
+                ipts=self.ipts,
+                output_dir=self.output_dir,
+                autoreduce_index=autoreduce_index,
             )
             if not self.live:
                 self.json_info = combined_catalog_info(
@@ -298,9 +312,14 @@ class ReductionProcess:
                     run_sample_number=str(RunSampleNumber(self.run_number, self.sample_number)),
                 )
             self.log("Matched runs: %s" % str(matched_runs))
-            # plotly figures for the reflectivity profile of each cross section, and embed them in an <div> container
+            # plotly figures for the reflectivity profile of each cross section, embedded in a <div> container
             ref_plot = plot_combined(
-                matched_runs, scaling_factors, self.ipts, extra_search_dir=self.output_dir, publish=False
+                matched_runs,
+                scaling_factors,
+                self.ipts,
+                extra_search_dir=self.output_dir,
+                publish=False,
+                autoreduce_index=autoreduce_index,
             )
             self.log("Generated reflectivity: %s" % len(str(ref_plot)))
         except:  # noqa E722
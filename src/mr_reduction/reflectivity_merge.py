@@ -5,27 +5,214 @@ Merging tools for REF_M
 
 # standard imports
 import datetime
+import functools
+import io
 import json
 import os
+import re
 import sys
 import time
-from glob import glob
-from typing import List, Tuple
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 # third party imports
 import mantid
 import mantid.simpleapi as api
 import numpy as np
-import pandas
 import pytz
 
 # mr_reduction iports
+from mr_reduction.reflectivity_output import DATA_ROW_FORMAT, DATASET_OPTIONS, DIRECT_BEAM_OPTIONS
 from mr_reduction.runsample import RunSampleNumber
-from mr_reduction.script_output import write_reduction_script, write_tunable_reduction_script
+from mr_reduction.script_output import _search_dirs, write_reduction_script, write_tunable_reduction_script
 from mr_reduction.settings import ar_out_dir, nexus_data_dir
 
+# File name of an autoreduced reflectivity profile, e.g. REF_M_12345_2_Off_Off_autoreduce.dat
+AUTOREDUCE_FILE_REGEX = re.compile(r"^REF_M_(\d+(?:_\d+)?)_(Off_Off|On_Off|Off_On|On_On)_autoreduce\.dat$")
 
-def match_run_for_cross_section(run, ipts, cross_section, extra_search_dir=None) -> List[str]:
+
+def _build_autoreduce_index(search_dirs) -> Dict[Tuple[str, str], str]:
+    r"""Find the autoreduced reflectivity profiles in the search directories with one listing per directory.
+
+    Parameters
+    ----------
+    search_dirs: List[str]
+        Directories to look into, in order of preference. When a file is found in more than one directory,
+        only the path in the first directory is kept.
+
+    Returns
+    -------
+    Dict[Tuple[str, str], str]
+        File paths of the REF_M_*_autoreduce.dat files, keyed by (RunSampleNumber, cross section),
+        e.g. {("12345_2", "Off_Off"): "/SNS/REF_M/IPTS-42666/shared/autoreduce/REF_M_12345_2_Off_Off_autoreduce.dat"}
+    """
+    index = dict()
+    for search_dir in search_dirs:
+        try:
+            with os.scandir(search_dir) as entries:
+                for entry in entries:
+                    match = AUTOREDUCE_FILE_REGEX.match(entry.name)
+                    if match and entry.is_file():
+                        index.setdefault((match.group(1), match.group(2)), entry.path)
+        except OSError:  # the directory doesn't exist or isn't readable
+            continue
+    return index
+
+
+def find_autoreduced_files(ipts: str, extra_search_dir: Optional[str] = None) -> Dict[Tuple[str, str], str]:
+    r"""Find the autoreduced reflectivity profiles (REF_M_*_autoreduce.dat) of an experiment.
+
+    The result can be passed on as argument `autoreduce_index` to the functions of this module, so that the
+    search directories are listed only once.
+
+    Parameters
+    ----------
+    ipts: str
+        Experiment identifier (e.g. 'IPTS-42666')
+    extra_search_dir: Optional[str]
+        Directory where to find the autoreduced files, in addition to the canonical autoreduce
+        directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+
+    Returns
+    -------
+    Dict[Tuple[str, str], str]
+        File paths keyed by (RunSampleNumber, cross section), e.g. ("12345_2", "Off_Off")
+    """
+    return _build_autoreduce_index(_search_dirs(ipts, extra_search_dir))
+
+
+# Contents of an autoreduced reflectivity profile (REF_M_*_autoreduce.dat)
+AutoreduceData = namedtuple("AutoreduceData", ["header", "data"])
+
+
+def _parse_autoreduce(file_path: str) -> AutoreduceData:
+    r"""Read an autoreduced reflectivity profile (REF_M_*_autoreduce.dat).
+
+    The contents are cached, so the file is read again only if its modification time (in nanoseconds)
+    or its size have changed since the last read.
+
+    Parameters
+    ----------
+    file_path: str
+        File to read
+
+    Returns
+    -------
+    AutoreduceData
+        header: Tuple[str] comment lines of the file, e.g. "# [Direct Beam Runs]\n"
+        data: numpy.ndarray read-only array with one row per Q-point and columns q, r, dr, dq, and a (theta)
+    """
+    stat = os.stat(file_path)
+    return _parse_autoreduce_cached(file_path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_autoreduce_cached(file_path: str, _mtime_ns: int, _size: int) -> AutoreduceData:
+    r"""Read the file in a single pass. Arguments `_mtime_ns` and `_size` are only used as part of the cache key"""
+    header, rows = [], []
+    with open(file_path, "r") as fd:
+        for line in fd:
+            if line.startswith("#"):
+                header.append(line)
+            elif line.strip():
+                rows.append(line)
+    # columns are q, r, dr, dq, and a. Parsed in double precision, so that the values written back into the
+    # combined files are the same as those read
+    if rows:
+        data = np.fromstring("".join(rows), dtype=np.float64, sep=" ").reshape(-1, 5)
+    else:  # header-only file. Parsing an empty string would return a spurious value
+        data = np.empty((0, 5), dtype=np.float64)
+    data.flags.writeable = False  # the cached array is shared by all callers
+    return AutoreduceData(tuple(header), data)
+
+
+def _parse_autoreduce_files(file_paths: List[str], max_workers: int = 8) -> List[AutoreduceData]:
+    r"""Read several autoreduced reflectivity profiles concurrently, overlapping the latency of the file reads.
+
+    Parameters
+    ----------
+    file_paths: List[str]
+        Files to read
+    max_workers: int
+        Maximum number of threads reading the files
+
+    Returns
+    -------
+    List[AutoreduceData]
+        Contents of the files, in the same order as `file_paths`
+    """
+    if len(file_paths) < 2:
+        return [_parse_autoreduce(file_path) for file_path in file_paths]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        return list(executor.map(_parse_autoreduce, file_paths))
+
+
+def _format_reflectivity(q, r, dr, dq, a) -> str:
+    r"""Format a reflectivity profile as text, one line per Q-point in the style of the autoreduced files"""
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack((q, r, dr, dq, a)), fmt=DATA_ROW_FORMAT)
+    return buffer.getvalue()
+
+
+def _bin_edges(q: np.ndarray) -> np.ndarray:
+    r"""Bin boundaries of a point profile, placed as in Mantid's ConvertToHistogram.
+
+    Inner boundaries lie halfway between consecutive points, and the outer boundaries lie half a spacing
+    beyond the first and last points.
+    """
+    if len(q) < 2:
+        raise ValueError("At least two points are required to convert a reflectivity profile to a histogram")
+    midpoints = 0.5 * (q[1:] + q[:-1])
+    return np.concatenate(([q[0] - (midpoints[0] - q[0])], midpoints, [q[-1] + (q[-1] - midpoints[-1])]))
+
+
+def _overlap_integral(edges: np.ndarray, r: np.ndarray, q_min: float, q_max: float) -> float:
+    r"""Sum of the bin contents within [q_min, q_max], including the fraction of the bins partially inside"""
+    widths = np.clip(np.minimum(edges[1:], q_max) - np.maximum(edges[:-1], q_min), 0.0, None)
+    return float(np.sum(r * widths / (edges[1:] - edges[:-1])))
+
+
+def _stitch_scale(q1, r1, q2, r2) -> float:
+    r"""Scaling factor to apply to a reflectivity profile so that it matches a lower-Q profile in their Q-overlap.
+
+    As in Mantid's Stitch1D, the profiles are converted to histograms, and the factor is the ratio of the
+    integral of the first profile to the integral of the second profile over the Q-overlap, the range from
+    the lower boundary of the second histogram to the upper boundary of the first one. Unlike Stitch1D,
+    the histograms are not rebinned to a common binning before integration, and bins partially within the
+    overlap contribute in proportion to the fraction of their width within the overlap.
+    The integrals are computed in double precision, whatever the precision of the input arrays.
+
+    Parameters
+    ----------
+    q1, r1: numpy.ndarray
+        Q-values and reflectivity of the lower-Q profile, with `q1` in increasing order
+    q2, r2: numpy.ndarray
+        Q-values and reflectivity of the profile to be scaled, with `q2` in increasing order
+
+    Returns
+    -------
+    float
+
+    Raises
+    ------
+    ValueError
+        The two profiles don't overlap or the second profile vanishes in the overlap
+    """
+    q1, r1, q2, r2 = (np.asarray(x, dtype=np.float64) for x in (q1, r1, q2, r2))
+    edges1, edges2 = _bin_edges(q1), _bin_edges(q2)
+    q_min, q_max = max(edges1[0], edges2[0]), min(edges1[-1], edges2[-1])
+    if q_min >= q_max:
+        raise ValueError("The reflectivity profiles don't overlap in Q")
+    denominator = _overlap_integral(edges2, r2, q_min, q_max)
+    if denominator <= 0:
+        raise ValueError("The reflectivity profile to be scaled vanishes in the Q-overlap")
+    return _overlap_integral(edges1, r1, q_min, q_max) / denominator
+
+
+def match_run_for_cross_section(
+    run, ipts, cross_section, extra_search_dir=None, autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None
+) -> List[str]:
     """Return a list of matching runs (or RunSampleNumber's) to be stitched
 
     Examples
@@ -49,19 +236,19 @@ def match_run_for_cross_section(run, ipts, cross_section, extra_search_dir=None)
     extra_search_dir: Optional[None]
         additional directory to look for matching runs for stitching
 
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+        If `None`, the search directories are listed.
+
     Returns
     -------
     List[str]
     """
     runsample = RunSampleNumber(run)
-    sample_number = runsample.sample_number
 
     # assemble the list of search directories
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
 
     _previous_q_min = 0
     _previous_q_max = 0
@@ -73,28 +260,40 @@ def match_run_for_cross_section(run, ipts, cross_section, extra_search_dir=None)
         if series_end:
             break
         i_runsample = RunSampleNumber(runsample.run_number - i, runsample.sample_number)
-        for search_dir in search_dirs:
-            file_path = os.path.join(search_dir, f"REF_M_{i_runsample}_{cross_section}_autoreduce.dat")
-            if os.path.isfile(file_path):
-                if RunSampleNumber(i_runsample).sample_number != sample_number:
-                    continue  # sample numbers must be the same
-                ref_data = pandas.read_csv(file_path, sep=r"\s+", comment="#", names=["q", "r", "dr", "dq", "a"])
-                q_min = min(ref_data["q"])
-                q_max = max(ref_data["q"])
-                api.logger.notice("%s: [%s %s]" % (i_runsample, q_min, q_max))
-
-                if (q_max < _previous_q_max and q_max > _previous_q_min) or _previous_q_max == 0:
-                    _previous_q_max = q_max
-                    _previous_q_min = q_min
-                    matched_runs.insert(0, str(i_runsample))
-                else:  # previous runs won't be a match, thus exit the `for i in range(10)` loop
-                    series_end = True
-
-                break  # no need to search in the other search directories
+        file_path = autoreduce_index.get((str(i_runsample), cross_section))
+        if file_path is not None:
+            q = _parse_autoreduce(file_path).data[:, 0]
+            if len(q) == 0:  # header-only file, as if no profile was found
+                continue
+            q_min = q.min()
+            q_max = q.max()
+            api.logger.notice("%s: [%s %s]" % (i_runsample, q_min, q_max))
+
+            if (q_max < _previous_q_max and q_max > _previous_q_min) or _previous_q_max == 0:
+                _previous_q_max = q_max
+                _previous_q_min = q_min
+                matched_runs.insert(0, str(i_runsample))
+            else:  # previous runs won't be a match, thus exit the `for i in range(10)` loop
+                series_end = True
 
     return matched_runs
 
 
+# Header lines of an autoreduced file marking the start of a section (e.g. "# [Data Runs]") or listing the
+# cross-section label (e.g. "# Extracted states: Off_Off")
+HEADER_MARKER_REGEX = re.compile(r"# (?:\[(?P<section>[^\]]*)\]|Extracted states:(?P<states>.*))")
+
+# Header sections of interest to `compute_scaling_factors`, and the state of the parser once the section starts
+HEADER_SECTION_BLOCKS = {"Direct Beam Runs": "direct_beam_columns", "Data Runs": "data_runs"}
+
+# Header lines of an autoreduced file read by `_extract_sequence_id`.
+# Maps the line prefix to the name of the extracted value, its converter, and its description for error messages
+SEQUENCE_HEADER_FIELDS = {
+    "# sequence_id": ("group_id", int, "group id"),
+    "# Input file indices:": ("run_sample_number", str, "run number"),
+}
+
+
 def _extract_sequence_id(file_path):
     """Extract the sequence_id from an autoreduced data file (REF_M_*_autoreduce.dat)
 
@@ -116,32 +315,32 @@ def _extract_sequence_id(file_path):
         lowest_q: float
     """
     assert file_path.endswith("autoreduce.dat"), "Input file is not an autoreduced data file"
-    run_sample_number, group_id, lowest_q = None, None, None
+    values = dict(run_sample_number=None, group_id=None)
+    lowest_q = None
     if os.path.isfile(file_path):
         with open(file_path, "r") as fd:
-            for line in fd.readlines():
-                if line.startswith("# sequence_id"):
-                    try:
-                        group_id = int(line[len("# sequence_id") :].strip())
-                    except:  # noqa E722
-                        api.logger.error("Could not extract group id from line: %s" % line)
-                if line.startswith("# Input file indices:"):
+            for line in fd:
+                if line.startswith("#"):
+                    for prefix, (name, convert, description) in SEQUENCE_HEADER_FIELDS.items():
+                        if line.startswith(prefix):
+                            try:
+                                values[name] = convert(line[len(prefix) :].strip())
+                            except ValueError:
+                                api.logger.error("Could not extract %s from line: %s" % (description, line))
+                            break
+                elif len(line.strip()) > 0:
+                    # the header is over and the first data row holds the lowest Q-value
                     try:
-                        run_sample_number = line[len("# Input file indices:") :].strip()
-                    except:  # noqa E722
-                        api.logger.error("Could not extract run number from line: %s" % line)
-                if not line.startswith("#") and len(line.strip()) > 0:
-                    try:
-                        toks = line.split()
-                        lowest_q = float(toks[0])
-                    except:  # noqa E722
+                        lowest_q = float(line.split()[0])
+                    except ValueError:
                         api.logger.error("Could not extract lowest q from line: %s" % line)
-                if all(x is not None for x in [run_sample_number, group_id, lowest_q]):
-                    return run_sample_number, group_id, lowest_q
-    return run_sample_number, group_id, lowest_q
+                    break
+    return values["run_sample_number"], values["group_id"], lowest_q
 
 
-def match_run_with_sequence(run, ipts, cross_section, extra_search_dir=None):
+def match_run_with_sequence(
+    run, ipts, cross_section, extra_search_dir=None, autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None
+):
     r"""List of matching runs (or RunSampleNumber's) to be stitched.
 
         Matching runs are searched in `search_dir` as well as in the canonical aoutoreduce directory,
@@ -165,6 +364,9 @@ def match_run_with_sequence(run, ipts, cross_section, extra_search_dir=None):
             polarization entry. One of "Off_Off", "On_Off", "Off_On", and "On_On"
     `    extra_search_dir: Optional[str]
             additional directory to find matching runs`
+        autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+            autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+            If `None`, the search directories are listed.
 
         Returns
         -------
@@ -175,36 +377,35 @@ def match_run_with_sequence(run, ipts, cross_section, extra_search_dir=None):
     api.logger.notice(f"Matching sequence for {ipts} r{runsample} [{cross_section}]")
 
     # assemble the list of data directories
-    data_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        data_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in data_dirs:
-        data_dirs.append(ar_out_dir(ipts))
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
 
     # Check to see if we have the sequence_id information
     group_id = None
-    for data_dir in data_dirs:
-        file_path = os.path.join(data_dir, f"REF_M_{runsample}_{cross_section}_autoreduce.dat")
-        if os.path.isfile(file_path):
-            _, group_id, _ = _extract_sequence_id(file_path)
-            break
+    file_path = autoreduce_index.get((str(runsample), cross_section))
+    if file_path is not None:
+        _, group_id, _ = _extract_sequence_id(file_path)
 
     # If we don't have a group id, just group together runs of increasing q-values
     if group_id is None:
-        return match_run_for_cross_section(runsample, ipts, cross_section, extra_search_dir=extra_search_dir)
+        return match_run_for_cross_section(
+            runsample, ipts, cross_section, extra_search_dir=extra_search_dir, autoreduce_index=autoreduce_index
+        )
 
     matched_runs = []  # list of [run-number, lowest-q] pairs
+    seen_runsamples = set()
     _lowest_q_available = True
-    for data_dir in data_dirs:
-        for file_path in glob(os.path.join(data_dir, f"REF_M_*_{cross_section}_autoreduce.dat")):
-            _runsample, _group_id, lowest_q = _extract_sequence_id(file_path)
-            if _runsample in [m[0] for m in matched_runs]:
-                continue  # this matching run number has been found in a previous data directory
-            if RunSampleNumber(_runsample).sample_number != sample_number:
-                continue  # the sample numbers must be the same
-            if _group_id == group_id:
-                matched_runs.append([str(_runsample), lowest_q])
-                _lowest_q_available = _lowest_q_available and lowest_q is not None
+    for (file_runsample, xs), file_path in autoreduce_index.items():
+        # filter by file name before opening the file. The sample numbers must be the same
+        if xs != cross_section or RunSampleNumber(file_runsample).sample_number != sample_number:
+            continue
+        _runsample, _group_id, lowest_q = _extract_sequence_id(file_path)
+        if str(_runsample) in seen_runsamples:
+            continue  # this matching run number has been found in a previous data directory
+        if _group_id == group_id:
+            matched_runs.append([str(_runsample), lowest_q])
+            seen_runsamples.add(str(_runsample))
+            _lowest_q_available = _lowest_q_available and lowest_q is not None
     if _lowest_q_available:  # sort by lowest-q
         match_series = [item[0] for item in sorted(matched_runs, key=lambda a: a[1])]
     else:  # sort by run-number
@@ -213,8 +414,12 @@ def match_run_with_sequence(run, ipts, cross_section, extra_search_dir=None):
 
 
 def compute_scaling_factors(
-    matched_runs, ipts, cross_section, extra_search_dir=None
-) -> Tuple[List[float], str, str, str, str]:
+    matched_runs,
+    ipts,
+    cross_section,
+    extra_search_dir=None,
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None,
+) -> Tuple[np.ndarray, str, str, str, str]:
     r"""Compute the scaling factors for an input set of runs (or RunSampleNumber's) by comparing with
     direct-beam runs having the same instrument configuration as the `matched_runs`.
 
@@ -234,105 +439,89 @@ def compute_scaling_factors(
     extra_search_dir: str
         Directory where to find the reduced matching runs, in addition to the canonicalautoreduce
         directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+        If `None`, the search directories are listed.
 
     Returns
     -------
-    Tuple[List[float], str, str, str, str]
-        scaling_factors: List[float]
+    Tuple[numpy.ndarray, str, str, str, str]
+        scaling_factors: numpy.ndarray
         direct_beam_info: str
         data_info: str
         data_buffer: str
         _cross_section_label: str Polarization state
     """
-    _previous_ws = None
+    _previous_data = None
     running_scale = 1.0
-    direct_beam_info = ""
-    data_buffer = ""
-    data_info = ""
+    direct_beam_lines = []
+    data_buffer_chunks = []
+    data_info_lines = []
     _cross_section_label = cross_section
 
     direct_beam_count = 0
     run_count = 0
     scaling_factors = [1.0]
 
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    search_dirs.append(ar_out_dir(ipts))
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
 
     for i_runsample in matched_runs:
-        for search_dir in search_dirs:
-            file_path = os.path.join(search_dir, "REF_M_%s_%s_autoreduce.dat" % (i_runsample, cross_section))
-            if os.path.isfile(file_path):
-                _file_handle = open(file_path, "r")
-                ref_data = pandas.read_csv(_file_handle, sep=r"\s+", comment="#", names=["q", "r", "dr", "dq", "a"])
-
-                ws = api.CreateWorkspace(DataX=ref_data["q"], DataY=ref_data["r"], DataE=ref_data["dr"])
-                ws = api.ConvertToHistogram(ws)
-                if _previous_ws is not None:
-                    _, scale = api.Stitch1D(_previous_ws, ws)
-                    running_scale *= scale
-                    scaling_factors.append(running_scale)
-                _previous_ws = api.CloneWorkspace(ws)
-
-                # Rewind and get meta-data
-                _file_handle.seek(0)
-                _direct_beams_started = 0
-                _data_runs_started = 0
-                for line in _file_handle.readlines():
-                    # Look for cross-section label
-                    if line.find("Extracted states:") > 0:
-                        toks = line.split(":")
-                        if len(toks) > 1:
-                            _cross_section_label = toks[1].strip()
-
-                    # If we are in the data run block, copy the data we need
-                    if _data_runs_started == 1 and line.find(str(i_runsample)) > 0:
-                        toks = ["%8s" % t for t in line.split()]
-                        if len(toks) > 10:
-                            toks[1] = "%8g" % scaling_factors[run_count]
-                            run_count += 1
-                            toks[14] = "%8s" % str(run_count)
-                            _line = "  ".join(toks).strip() + "\n"
-                            data_info += _line.replace("# ", "#")
-
-                    # Find out whether we started the direct beam block
-                    if line.find("Data Runs") > 0:
-                        _direct_beams_started = 0
-                        _data_runs_started = 1
-
-                    # Get the direct beam info
-                    if _direct_beams_started == 2:
-                        toks = ["%8s" % t for t in line.split()]
-                        if len(toks) > 10:
-                            direct_beam_count += 1
-                            toks[1] = "%8g" % direct_beam_count
-                            _line = "  ".join(toks).strip() + "\n"
-                            direct_beam_info += _line.replace("# ", "#")
-
-                    # If we are in the direct beam block, we need to skip the column info line
-                    if _direct_beams_started == 1 and line.find("DB_ID") > 0:
-                        _direct_beams_started = 2
-
-                    # Find out whether we started the direct beam block
-                    if line.find("Direct Beam Runs") > 0:
-                        _direct_beams_started = 1
-
-                for i in range(len(ref_data["q"])):
-                    data_buffer += "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n" % (
-                        ref_data["q"][i],
-                        running_scale * ref_data["r"][i],
-                        running_scale * ref_data["dr"][i],
-                        ref_data["dq"][i],
-                        ref_data["a"][i],
-                    )
-                break  # no need to search in the other search directories
-
-    return scaling_factors, direct_beam_info, data_info, data_buffer, _cross_section_label
+        file_path = autoreduce_index.get((str(i_runsample), cross_section))
+        if file_path is not None:
+            header, ref_data = _parse_autoreduce(file_path)
+            q, r, dr, dq, a = ref_data.T
+
+            if _previous_data is not None:
+                running_scale *= _stitch_scale(*_previous_data, q, r)
+                scaling_factors.append(running_scale)
+            _previous_data = (q, r)
+
+            # Get meta-data. Blocks of interest start with a section line (e.g. "# [Data Runs]"), and in the case of
+            # the direct beam block, the column info line (containing "DB_ID") must be skipped
+            block = None
+            for line in header:
+                marker = HEADER_MARKER_REGEX.match(line)
+                if marker is not None:
+                    if marker["section"] is not None:
+                        block = HEADER_SECTION_BLOCKS.get(marker["section"])
+                    else:
+                        _cross_section_label = marker["states"].split(":")[0].strip()
+                elif block == "direct_beam_columns":
+                    if "DB_ID" in line:
+                        block = "direct_beams"
+                elif block == "direct_beams":
+                    toks = ["%8s" % t for t in line.split()]
+                    if len(toks) > 10:
+                        direct_beam_count += 1
+                        toks[1] = "%8g" % direct_beam_count
+                        _line = "  ".join(toks).strip() + "\n"
+                        direct_beam_lines.append(_line.replace("# ", "#"))
+                elif block == "data_runs" and str(i_runsample) in line:
+                    # Copy the data we need
+                    toks = ["%8s" % t for t in line.split()]
+                    if len(toks) > 10:
+                        toks[1] = "%8g" % scaling_factors[run_count]
+                        run_count += 1
+                        toks[14] = "%8s" % str(run_count)
+                        _line = "  ".join(toks).strip() + "\n"
+                        data_info_lines.append(_line.replace("# ", "#"))
+
+            data_buffer_chunks.append(_format_reflectivity(q, running_scale * r, running_scale * dr, dq, a))
+
+    direct_beam_info = "".join(direct_beam_lines)
+    data_info = "".join(data_info_lines)
+    data_buffer = "".join(data_buffer_chunks)
+    return np.array(scaling_factors), direct_beam_info, data_info, data_buffer, _cross_section_label
 
 
 def apply_scaling_factors(
-    matched_runs, ipts, cross_section, scaling_factors, extra_search_dir=None
+    matched_runs,
+    ipts,
+    cross_section,
+    scaling_factors,
+    extra_search_dir=None,
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None,
 ) -> List[Tuple[str, str]]:
     r"""Apply the scaling factors (used for stitching) that were computed with the cross-section having the highest
     event count to rescale the reflectivity profiles of the other cross-sections.
@@ -351,11 +540,14 @@ def apply_scaling_factors(
     cross_section: str
         polarization entry. One of "Off_Off", "On_Off", "Off_On", and "On_On". It should be the cross section
         with the highest event count.
-    scaling_factors: List[float]
+    scaling_factors: numpy.ndarray
         Numbers by which to multiply each matched reflectivity curve, when stitching
     extra_search_dir: Optional[str]
         additional directory where to find matching partial scripts for the matching runs. Search is also
         carried out on the canonical autoreduce directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+        If `None`, the search directories are listed.
 
     Returns
     -------
@@ -364,42 +556,41 @@ def apply_scaling_factors(
         input `cross_section`, e.g ('On_Off', '0.02344 5.666 ....'), ("On_On", '')
     """
 
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
-
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
+
+    # Skip the cross section that we computed the scaling factors with since we havce that data already
+    other_cross_sections = [xs for xs in ["Off_Off", "On_Off", "Off_On", "On_On"] if xs != cross_section]
+
+    # Read the files of all cross sections at once
+    found = []  # list of (cross-section, scaling factor, file path) triads
+    for xs in other_cross_sections:
+        for i_runsample, scaling_factor in zip(matched_runs, scaling_factors, strict=True):
+            file_path = autoreduce_index.get((str(i_runsample), xs))
+            if file_path is not None:
+                found.append((xs, scaling_factor, file_path))
+    contents = _parse_autoreduce_files([file_path for _, _, file_path in found])
+
+    # Concatenate the profiles of one cross-section, rescale columns r and dr, then format them at once
+    profiles = {xs: ([], []) for xs in other_cross_sections}  # reflectivity profiles and their scaling factors
+    for (xs, scaling_factor, _), (_, ref_data) in zip(found, contents):
+        profiles[xs][0].append(ref_data)
+        profiles[xs][1].append(scaling_factor)
     data_buffers = []
-    for xs in ["Off_Off", "On_Off", "Off_On", "On_On"]:
-        # Skip the cross section that we computed the scaling factors with since we havce that data already
-        if xs == cross_section:
-            continue
+    for xs, (xs_profiles, xs_factors) in profiles.items():
         data_buffer = ""
-
-        for j, i_runsample in enumerate(matched_runs):
-            for search_dir in search_dirs:
-                file_path = os.path.join(search_dir, "REF_M_%s_%s_autoreduce.dat" % (i_runsample, xs))
-                if os.path.isfile(file_path):
-                    with open(file_path, "r") as file_handle:
-                        ref_data = pandas.read_csv(
-                            file_handle, sep=r"\s+", comment="#", names=["q", "r", "dr", "dq", "a"]
-                        )
-                    for i in range(len(ref_data["q"])):
-                        data_buffer += "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n" % (
-                            ref_data["q"][i],
-                            scaling_factors[j] * ref_data["r"][i],
-                            scaling_factors[j] * ref_data["dr"][i],
-                            ref_data["dq"][i],
-                            ref_data["a"][i],
-                        )
-                    break  # no need to search in the other search directory
-
+        if xs_profiles:
+            # a double-precision copy, since the cached profiles are read-only
+            data = np.concatenate(xs_profiles, dtype=np.float64)
+            data[:, 1:3] *= np.repeat(xs_factors, [len(profile) for profile in xs_profiles])[:, np.newaxis]
+            data_buffer = _format_reflectivity(*data.T)
         data_buffers.append((xs, data_buffer))
     return data_buffers
 
 
-def select_cross_section(run, ipts, extra_search_dir=None):
+def select_cross_section(
+    run, ipts, extra_search_dir=None, autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None
+):
     r"""Select the cross-section with the lowest relative error
 
     Parameters
@@ -411,33 +602,35 @@ def select_cross_section(run, ipts, extra_search_dir=None):
     extra_search_dir: Optional[str]
         additional directory where to find reflectivity profiles for each cross section of the matching runs.
         Search will also be carried out the canonical autoreduce directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+        If `None`, the search directories are listed.
 
     Returns
     -------
     str
         One of "Off_Off", "On_Off", "Off_On", and "On_On"
     """
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
 
     runsample = RunSampleNumber(run)  # e.g. "12345" or "12345_2"
     best_xs = None
     best_error = None
 
     for xs in ["Off_Off", "On_Off", "Off_On", "On_On"]:
-        for search_dir in search_dirs:
-            file_path = os.path.join(search_dir, f"REF_M_{runsample}_{xs}_autoreduce.dat")
-            if os.path.isfile(file_path):
-                api.logger.notice("Found: %s" % file_path)
-                ref_data = pandas.read_csv(file_path, sep=r"\s+", comment="#", names=["q", "r", "dr", "dq", "a"])
-                relative_error = np.sum(ref_data["dr"] * ref_data["dr"]) / np.sum(ref_data["r"])
-                if best_xs is None or relative_error < best_error:
-                    best_xs = xs
-                    best_error = relative_error
-                break  # no need to search in the other search directory
+        file_path = autoreduce_index.get((str(runsample), xs))
+        if file_path is not None:
+            api.logger.notice("Found: %s" % file_path)
+            data = _parse_autoreduce(file_path).data
+            r, dr = data[:, 1], data[:, 2]
+            r_sum = np.sum(r, dtype=np.float64)
+            if r_sum <= 0:  # empty or vanishing profile, the relative error is undefined
+                continue
+            relative_error = float(np.sum(dr * dr, dtype=np.float64) / r_sum)
+            if best_xs is None or relative_error < best_error:
+                best_xs = xs
+                best_error = relative_error
     return best_xs
 
 
@@ -476,72 +669,47 @@ def write_reflectivity_cross_section(
     str
         File path to the reflectivity profile
     """
-    direct_beam_options = [
-        "DB_ID",
-        "P0",
-        "PN",
-        "x_pos",
-        "x_width",
-        "y_pos",
-        "y_width",
-        "bg_pos",
-        "bg_width",
-        "dpix",
-        "tth",
-        "number",
-        "File",
-    ]
-    dataset_options = [
-        "scale",
-        "P0",
-        "PN",
-        "x_pos",
-        "x_width",
-        "y_pos",
-        "y_width",
-        "bg_pos",
-        "bg_width",
-        "fan",
-        "dpix",
-        "tth",
-        "number",
-        "DB_ID",
-        "File",
-    ]
-
     if output_dir is None or os.path.isdir(output_dir) is False:
         output_dir = ar_out_dir(ipts)
     file_path = os.path.join(output_dir, "REF_M_%s_%s_combined.dat" % (runsample, cross_section))
-    with open(file_path, "w") as fd:
-        fd.write("# Datafile created by QuickNXS 1.0.32\n")
-        fd.write("# Datafile created by Mantid %s\n" % mantid.__version__)
-        fd.write("# Date: %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
-        fd.write("# Type: Specular\n")
-        fd.write("# Input file indices: %s\n" % ",".join(matched_runs))
-        fd.write("# Extracted states: %s\n" % xs_label)
-        fd.write("#\n")
-        fd.write("# [Direct Beam Runs]\n")
-        toks = ["%8s" % item for item in direct_beam_options]
-        fd.write("# %s\n" % "  ".join(toks))
-        fd.write(direct_beam_info)
-        fd.write("#\n")
-        fd.write("# [Data Runs]\n")
-        toks = ["%8s" % item for item in dataset_options]
-        fd.write("# %s\n" % "  ".join(toks))
-        fd.write(data_info)
-        fd.write("#\n")
-        fd.write("# [Global Options]\n")
-        fd.write("# name           value\n")
-        fd.write("# sample_length  10\n")
-        fd.write("#\n")
-        fd.write("# [Data]\n")
-        toks = ["%12s" % item for item in ["Qz [1/A]", "R [a.u.]", "dR [a.u.]", "dQz [1/A]", "theta [rad]"]]
-        fd.write("# %s\n" % "  ".join(toks))
+    header_lines = [
+        "# Datafile created by QuickNXS 1.0.32\n",
+        "# Datafile created by Mantid %s\n" % mantid.__version__,
+        "# Date: %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"),
+        "# Type: Specular\n",
+        "# Input file indices: %s\n" % ",".join(matched_runs),
+        "# Extracted states: %s\n" % xs_label,
+        "#\n",
+        "# [Direct Beam Runs]\n",
+        "# %s\n" % "  ".join(["%8s" % item for item in DIRECT_BEAM_OPTIONS]),
+        direct_beam_info,
+        "#\n",
+        "# [Data Runs]\n",
+        "# %s\n" % "  ".join(["%8s" % item for item in DATASET_OPTIONS]),
+        data_info,
+        "#\n",
+        "# [Global Options]\n",
+        "# name           value\n",
+        "# sample_length  10\n",
+        "#\n",
+        "# [Data]\n",
+        "# %s\n"
+        % "  ".join(["%12s" % item for item in ["Qz [1/A]", "R [a.u.]", "dR [a.u.]", "dQz [1/A]", "theta [rad]"]]),
+    ]
+    with open(file_path, "w", buffering=1 << 20) as fd:
+        fd.writelines(header_lines)
         fd.write(data_buffer)
     return file_path
 
 
-def plot_combined(matched_runs, scaling_factors, ipts, extra_search_dir=None, publish=True):
+def plot_combined(
+    matched_runs,
+    scaling_factors,
+    ipts,
+    extra_search_dir=None,
+    publish=True,
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None,
+):
     r"""Create plotly figures for the reflectivity profile of each cross section, and embed them in an <div> container.
 
     Parameters
@@ -550,7 +718,7 @@ def plot_combined(matched_runs, scaling_factors, ipts, extra_search_dir=None, pu
         List of RunSampleNumber's (e.g. ['1234', '1235'] or ['1234_2', '1235_2']) if reducing only the second
         sample present in the experiments. Runs are ordered by increasing Q, which are to be reduced and
         stitched together.
-    scaling_factors: List[float]
+    scaling_factors: numpy.ndarray
         Numbers by which to multiply each matched reflectivity curve, when stitching
     ipts: str
         Experiment identifier (e.g. "IPTS-42666")
@@ -559,32 +727,32 @@ def plot_combined(matched_runs, scaling_factors, ipts, extra_search_dir=None, pu
         Search will also be carried out the canonical autoreduce directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
     publish: bool
         if True, store the HTML page in the livedata server
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in the search directories, as returned by `_build_autoreduce_index`.
+        If `None`, the search directories are listed.
 
     Returns
     -------
     str
         The contents inside the <div>..</div> element
     """
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, extra_search_dir)
 
     # Collect reflectivity profiles for each cross section
     data_names = []  # list of cross sections
     data_list = []  # a list of reflectivity profiles with columns Q, r, and dr. One profile for each cross section
+    found = []  # list of (index of the matched run, file path) pairs
     for i, runsample in enumerate(matched_runs):
         for xs in ["Off_Off", "On_Off", "Off_On", "On_On"]:
-            for search_dir in search_dirs:
-                file_path = os.path.join(search_dir, "REF_M_%s_%s_autoreduce.dat" % (runsample, xs))
-                if os.path.isfile(file_path):
-                    ref_data = pandas.read_csv(file_path, sep=r"\s+", comment="#", names=["q", "r", "dr", "dq", "a"])
-                    data_list.append(
-                        [ref_data["q"], scaling_factors[i] * ref_data["r"], scaling_factors[i] * ref_data["dr"]]
-                    )
-                    data_names.append("r%s [%s]" % (runsample, xs))
-                    break  # no need to search in the other search directory
+            file_path = autoreduce_index.get((str(runsample), xs))
+            if file_path is not None:
+                found.append((i, file_path))
+                data_names.append("r%s [%s]" % (runsample, xs))
+    contents = _parse_autoreduce_files([file_path for _, file_path in found])
+    for (i, _), (_, ref_data) in zip(found, contents):
+        q, r, dr, _, _ = ref_data.T
+        data_list.append([q, scaling_factors[i] * r, scaling_factors[i] * dr])
 
     try:
         # Depending on where we run, we might get our publisher from different places, or not at all.
@@ -613,7 +781,7 @@ def plot_combined(matched_runs, scaling_factors, ipts, extra_search_dir=None, pu
     return None
 
 
-def combined_curves(run, ipts, output_dir=None):
+def combined_curves(run, ipts, output_dir=None, autoreduce_index: Optional[Dict[Tuple[str, str], str]] = None):
     r"""Stitch reflectivity curves from different runs of the same group.
 
     Runs of the same group were produced with the same sample and different incident angle
@@ -627,27 +795,37 @@ def combined_curves(run, ipts, output_dir=None):
     output_dir: Optional[str]
         directory where to write the stitched reflectivity curve. Defaults to the canonical autoreduce
         directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+    autoreduce_index: Optional[Dict[Tuple[str, str], str]]
+        autoreduced files found in `output_dir` and the canonical autoreduce directory, as returned by
+        `find_autoreduced_files`. If `None`, the directories are listed.
 
     Returns
     -------
-    Tuple[List[str], List[float], List[str]]
+    Tuple[List[str], numpy.ndarray, List[str]]
         matched_runs: List[str] Data runs (or RunSampleNumber's) ordered by increasing Q, to be stitched together
-        scaling_factors: List[float] numbers by which to multiply each matched reflectivity curve, when stitching
+        scaling_factors: numpy.ndarray numbers by which to multiply each matched reflectivity curve, when stitching
         file_list: List[str]] paths to the reflectivity profile files, one file for each cross section.
     """
     runsample = RunSampleNumber(run)  # e.g. "12345", "12345_2"
+
+    # Find the autoreduced files only once, for all the steps below
+    if autoreduce_index is None:
+        autoreduce_index = find_autoreduced_files(ipts, output_dir)
+
     # Select the cross section with the best statistics
-    high_stat_xs = select_cross_section(runsample, ipts, extra_search_dir=output_dir)
+    high_stat_xs = select_cross_section(runsample, ipts, autoreduce_index=autoreduce_index)
     api.logger.notice("High xs: %s" % high_stat_xs)
 
     # Match the given run with previous runs if they are overlapping in Q
-    matched_runs = match_run_with_sequence(runsample, ipts, high_stat_xs, extra_search_dir=output_dir)
+    matched_runs = match_run_with_sequence(
+        runsample, ipts, high_stat_xs, extra_search_dir=output_dir, autoreduce_index=autoreduce_index
+    )
     api.logger.notice("Matched runs: %s" % str(matched_runs))
 
     # Compute scaling factors for this cross section
     try:
         scaling_factors, direct_beam_info, data_info, data_buffer, xs_label = compute_scaling_factors(
-            matched_runs, ipts, high_stat_xs, extra_search_dir=output_dir
+            matched_runs, ipts, high_stat_xs, autoreduce_index=autoreduce_index
         )
     except:  # noqa E722
         return matched_runs, np.ones(len(matched_runs)), [""] * len(matched_runs)
@@ -656,7 +834,9 @@ def combined_curves(run, ipts, output_dir=None):
     write_reduction_script(matched_runs, scaling_factors, ipts, output_dir=output_dir, extra_search_dir=output_dir)
     write_tunable_reduction_script(matched_runs, scaling_factors, ipts, output_dir=output_dir)
 
-    xs_buffers = apply_scaling_factors(matched_runs, ipts, high_stat_xs, scaling_factors, extra_search_dir=output_dir)
+    xs_buffers = apply_scaling_factors(
+        matched_runs, ipts, high_stat_xs, scaling_factors, autoreduce_index=autoreduce_index
+    )
     xs_buffers.append((high_stat_xs, data_buffer))
 
     file_list = []
@@ -9,10 +9,136 @@ import time
 
 # third party imports
 import mantid
+import numpy as np
 
 # mr_reduction imports
 from mr_reduction.runsample import RunSampleNumber
 
+# Columns of the [Direct Beam Runs] section
+DIRECT_BEAM_OPTIONS = (
+    "DB_ID",
+    "P0",
+    "PN",
+    "x_pos",
+    "x_width",
+    "y_pos",
+    "y_width",
+    "bg_pos",
+    "bg_width",
+    "dpix",
+    "tth",
+    "number",
+    "File",
+)
+
+# Columns of the [Data Runs] section
+DATASET_OPTIONS = (
+    "scale",
+    "P0",
+    "PN",
+    "x_pos",
+    "x_width",
+    "y_pos",
+    "y_width",
+    "bg_pos",
+    "bg_width",
+    "fan",
+    "dpix",
+    "tth",
+    "number",
+    "DB_ID",
+    "File",
+)
+
+# Converts two-theta in degrees to theta in radians
+TWO_THETA_DEG_TO_THETA_RAD = math.pi / 360.0
+
+# Converts radians to degrees
+RAD_TO_DEG = 180.0 / math.pi
+
+# Format of the rows of the [Data] section, with columns Q, R, dR, dQ, and theta
+DATA_ROW_FORMAT = "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g"
+
+# Sample logs read for each entry of the [Direct Beam Runs] section
+DIRECT_BEAM_LOGS = (
+    "norm_peak_min",
+    "norm_peak_max",
+    "norm_bg_min",
+    "norm_bg_max",
+    "norm_low_res_min",
+    "norm_low_res_max",
+    "normalization_dirpix",
+    "normalization_file_path",
+)
+
+# Sample logs read by `_quicknxs_scaling_factor_from_logs`
+QUICKNXS_SCALING_LOGS = (
+    "scatt_peak_min",
+    "scatt_peak_max",
+    "scatt_low_res_min",
+    "scatt_low_res_max",
+    "norm_peak_min",
+    "norm_peak_max",
+    "norm_low_res_min",
+    "norm_low_res_max",
+    "two_theta",
+)
+
+# Sample logs read for each entry of the [Data Runs] section, including those for `_quicknxs_scaling_factor_from_logs`
+DATA_RUN_LOGS = QUICKNXS_SCALING_LOGS + ("scatt_bg_min", "scatt_bg_max", "constant_q_binning", "specular_pixel")
+
+
+def _legacy_filename(filename: str) -> str:
+    r"""In order to make the file loadable by QuickNXS, we have to change the
+    file name to the re-processed and legacy-compatible files.
+    The new QuickNXS can load both.
+
+    Example: /SNS/REF_M/IPTS-42666/nexus/REF_M_12345.nxs.h5 becomes /SNS/REF_M/IPTS-42666/data/REF_M_12345_histo.nxs
+    """
+    if filename.endswith("nxs.h5"):
+        return filename.replace("nexus", "data").replace(".nxs.h5", "_histo.nxs")
+    return filename
+
+
+def _log_values(run_object, log_names) -> dict:
+    r"""Values of the sample logs of a run, keyed by log name, fetching each log only once"""
+    return {name: run_object.getProperty(name).value for name in log_names}
+
+
+# Pixel width in meters, keyed by instrument name and definition date, which is the same for all runs
+# measured with the same instrument definition
+_pixel_widths = {}
+
+
+def _pixel_width(instrument) -> float:
+    r"""Pixel width of the detector in meters, from instrument parameter "pixel-width" if defined.
+    Looked up only once per instrument definition."""
+    key = (instrument.getName(), str(instrument.getValidFromDate()))
+    if key not in _pixel_widths:
+        if instrument.hasParameter("pixel-width"):
+            _pixel_widths[key] = float(instrument.getNumberParameter("pixel-width")[0]) / 1000.0
+        else:
+            _pixel_widths[key] = 0.0007
+    return _pixel_widths[key]
+
+
+def _option_row_format(options, text_options=("number", "File")) -> str:
+    r"""Format string for the rows of the [Direct Beam Runs] or [Data Runs] section, with the values of
+    `text_options` formatted as text and the other values formatted as numbers"""
+    return "# %s\n" % "  ".join(["%8s" if option in text_options else "%8g" for option in options])
+
+
+# Format strings for the rows of the [Direct Beam Runs] and [Data Runs] sections
+DIRECT_BEAM_ROW_FORMAT = _option_row_format(DIRECT_BEAM_OPTIONS)
+DATASET_ROW_FORMAT = _option_row_format(DATASET_OPTIONS)
+
+# Column-name lines of the [Direct Beam Runs], [Data Runs], and [Data] sections
+DIRECT_BEAM_HEADER = "# %s\n" % "  ".join(["%8s" % option for option in DIRECT_BEAM_OPTIONS])
+DATASET_HEADER = "# %s\n" % "  ".join(["%8s" % option for option in DATASET_OPTIONS])
+DATA_HEADER = "# %s\n" % "  ".join(
+    ["%12s" % column for column in ("Qz [1/A]", "R [a.u.]", "dR [a.u.]", "dQz [1/A]", "theta [rad]")]
+)
+
 
 def write_reflectivity(ws_list, output_path, cross_section):
     r"""Write out reflectivity output (usually from autoreduction, as file REF_M_*_autoreduce.dat)"""
@@ -20,236 +146,177 @@ def write_reflectivity(ws_list, output_path, cross_section):
     if not ws_list:
         return
 
-    direct_beam_options = [
-        "DB_ID",
-        "P0",
-        "PN",
-        "x_pos",
-        "x_width",
-        "y_pos",
-        "y_width",
-        "bg_pos",
-        "bg_width",
-        "dpix",
-        "tth",
-        "number",
-        "File",
-    ]
-    dataset_options = [
-        "scale",
-        "P0",
-        "PN",
-        "x_pos",
-        "x_width",
-        "y_pos",
-        "y_width",
-        "bg_pos",
-        "bg_width",
-        "fan",
-        "dpix",
-        "tth",
-        "number",
-        "DB_ID",
-        "File",
-    ]
-
-    fd = open(output_path, "w")
-    fd.write("# Datafile created by QuickNXS 2.0.0\n")
-    fd.write("# Datafile created by Mantid %s\n" % mantid.__version__)
-    fd.write("# Autoreduced\n")
-    fd.write("# Date: %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
-    fd.write("# Type: Specular\n")
     sample_number = RunSampleNumber.sample_number_log(ws_list[0])
-    runsample_list = [str(RunSampleNumber(str(ws.getRunNumber()), sample_number)) for ws in ws_list]
-    fd.write(f"# Input file indices: {','.join(runsample_list)}\n")
-    fd.write("# Extracted states: %s\n" % cross_section)
-    fd.write("#\n")
-    fd.write("# [Direct Beam Runs]\n")
-    toks = ["%8s" % item for item in direct_beam_options]
-    fd.write("# %s\n" % "  ".join(toks))
-
-    # Direct beam section
-    i_direct_beam = 0
-    for ws in ws_list:
-        i_direct_beam += 1
-        run_object = ws.getRun()
-        normalization_run = run_object.getProperty("normalization_run").value
-        if normalization_run == "None":
-            continue
-        peak_min = run_object.getProperty("norm_peak_min").value
-        peak_max = run_object.getProperty("norm_peak_max").value
-        bg_min = run_object.getProperty("norm_bg_min").value
-        bg_max = run_object.getProperty("norm_bg_max").value
-        low_res_min = run_object.getProperty("norm_low_res_min").value
-        low_res_max = run_object.getProperty("norm_low_res_max").value
-        dpix = run_object.getProperty("normalization_dirpix").value
-        filename = run_object.getProperty("normalization_file_path").value
-        # In order to make the file loadable by QuickNXS, we have to change the
-        # file name to the re-processed and legacy-compatible files.
-        # The new QuickNXS can load both.
-        if filename.endswith("nxs.h5"):
-            filename = filename.replace("nexus", "data")
-            filename = filename.replace(".nxs.h5", "_histo.nxs")
-
-        item = dict(
-            DB_ID=i_direct_beam,
-            tth=0,
-            P0=0,
-            PN=0,
-            x_pos=(peak_min + peak_max) / 2.0,
-            x_width=peak_max - peak_min + 1,
-            y_pos=(low_res_max + low_res_min) / 2.0,
-            y_width=low_res_max - low_res_min + 1,
-            bg_pos=(bg_min + bg_max) / 2.0,
-            bg_width=bg_max - bg_min + 1,
-            dpix=dpix,
-            number=normalization_run,
-            File=filename,
+    runsamples = ",".join(str(RunSampleNumber(ws.getRunNumber(), sample_number)) for ws in ws_list)
+    with open(output_path, "w", buffering=1 << 20) as fd:  # a 1 MiB buffer holds typical reflectivity files whole
+        fd.writelines(
+            [
+                "# Datafile created by QuickNXS 2.0.0\n",
+                "# Datafile created by Mantid %s\n" % mantid.__version__,
+                "# Autoreduced\n",
+                "# Date: %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"),
+                "# Type: Specular\n",
+                "# Input file indices: %s\n" % runsamples,
+                "# Extracted states: %s\n" % cross_section,
+                "#\n",
+                "# [Direct Beam Runs]\n",
+                DIRECT_BEAM_HEADER,
+            ]
         )
 
-        par_list = ["{%s}" % p for p in direct_beam_options]
-        template = "# %s\n" % "  ".join(par_list)
-        _clean_dict = {}
-        for key in item:
-            if isinstance(item[key], (bool, str)):
-                _clean_dict[key] = "%8s" % item[key]
-            else:
-                _clean_dict[key] = "%8g" % item[key]
-        fd.write(template.format(**_clean_dict))
-
-    # Scattering data
-    fd.write("#\n")
-    fd.write("# [Data Runs]\n")
-    toks = ["%8s" % item for item in dataset_options]
-    fd.write("# %s\n" % "  ".join(toks))
-    i_direct_beam = 0
-
-    data_block = ""
-    for ws in ws_list:
-        i_direct_beam += 1
-
-        run_object = ws.getRun()
-        peak_min = run_object.getProperty("scatt_peak_min").value
-        peak_max = run_object.getProperty("scatt_peak_max").value
-        bg_min = run_object.getProperty("scatt_bg_min").value
-        bg_max = run_object.getProperty("scatt_bg_max").value
-        low_res_min = run_object.getProperty("scatt_low_res_min").value
-        low_res_max = run_object.getProperty("scatt_low_res_max").value
-        dpix = run_object.getProperty("DIRPIX").getStatistics().mean
-        # For live data, we might not have a file name
-        if "Filename" in run_object:
-            filename = run_object.getProperty("Filename").value
-            # In order to make the file loadable by QuickNXS, we have to change the
-            # file name to the re-processed and legacy-compatible files.
-            # The new QuickNXS can load both.
-            if filename.endswith("nxs.h5"):
-                filename = filename.replace("nexus", "data")
-                filename = filename.replace(".nxs.h5", "_histo.nxs")
-        else:
-            filename = "live data"
-        constant_q_binning = run_object.getProperty("constant_q_binning").value
-        scatt_pos = run_object.getProperty("specular_pixel").value
-        # norm_x_min = run_object.getProperty("norm_peak_min").value
-        # norm_x_max = run_object.getProperty("norm_peak_max").value
-        # norm_y_min = run_object.getProperty("norm_low_res_min").value
-        # norm_y_max = run_object.getProperty("norm_low_res_max").value
-
-        # For some reason, the tth value that QuickNXS expects is offset.
-        # It seems to be because that same offset is applied later in the QuickNXS calculation.
-        # Correct tth here so that it can load properly in QuickNXS and produce the same result.
-        tth = run_object.getProperty("two_theta").value
-        det_distance = run_object["SampleDetDis"].getStatistics().mean
-        # Check units
-        if run_object["SampleDetDis"].units not in ["m", "meter"]:
-            det_distance /= 1000.0
-        direct_beam_pix = run_object["DIRPIX"].getStatistics().mean
-
-        # Get pixel size from instrument properties
-        if ws.getInstrument().hasParameter("pixel-width"):
-            pixel_width = float(ws.getInstrument().getNumberParameter("pixel-width")[0]) / 1000.0
-        else:
-            pixel_width = 0.0007
-        tth -= ((direct_beam_pix - scatt_pos) * pixel_width) / det_distance * 180.0 / math.pi
-
-        item = dict(
-            scale=1,
-            DB_ID=i_direct_beam,
-            P0=0,
-            PN=0,
-            tth=tth,
-            fan=constant_q_binning,
-            x_pos=scatt_pos,
-            x_width=peak_max - peak_min + 1,
-            y_pos=(low_res_max + low_res_min) / 2.0,
-            y_width=low_res_max - low_res_min + 1,
-            bg_pos=(bg_min + bg_max) / 2.0,
-            bg_width=bg_max - bg_min + 1,
-            dpix=dpix,
-            number=str(ws.getRunNumber()),
-            File=filename,
-        )
+        # Direct beam section
+        run_objects = [ws.getRun() for ws in ws_list]  # shared by all sections
+        rows = []  # rows of the section, written to file in one call
+        i_direct_beam = 0
+        for run_object in run_objects:
+            i_direct_beam += 1
+            normalization_run = run_object.getProperty("normalization_run").value
+            if normalization_run == "None":
+                continue
+            logs = _log_values(run_object, DIRECT_BEAM_LOGS)
+            peak_min, peak_max = logs["norm_peak_min"], logs["norm_peak_max"]
+            bg_min, bg_max = logs["norm_bg_min"], logs["norm_bg_max"]
+            low_res_min, low_res_max = logs["norm_low_res_min"], logs["norm_low_res_max"]
+            dpix = logs["normalization_dirpix"]
+            filename = _legacy_filename(logs["normalization_file_path"])
+
+            # values in the order of DIRECT_BEAM_OPTIONS
+            row = (
+                i_direct_beam,  # DB_ID
+                0,  # P0
+                0,  # PN
+                (peak_min + peak_max) / 2.0,  # x_pos
+                peak_max - peak_min + 1,  # x_width
+                (low_res_max + low_res_min) / 2.0,  # y_pos
+                low_res_max - low_res_min + 1,  # y_width
+                (bg_min + bg_max) / 2.0,  # bg_pos
+                bg_max - bg_min + 1,  # bg_width
+                dpix,  # dpix
+                0,  # tth
+                normalization_run,  # number
+                filename,  # File
+            )
+            rows.append(DIRECT_BEAM_ROW_FORMAT % row)
+        fd.writelines(rows)
+
+        # Scattering data
+        rows = ["#\n", "# [Data Runs]\n", DATASET_HEADER]
+        i_direct_beam = 0
 
-        par_list = ["{%s}" % p for p in dataset_options]
-        template = "# %s\n" % "  ".join(par_list)
-        _clean_dict = {}
-        for key in item:
-            if isinstance(item[key], str):
-                _clean_dict[key] = "%8s" % item[key]
+        data_scaling = []  # (theta, QuickNXS scaling factor) for each workspace, used when writing the [Data] section
+        for ws, run_object in zip(ws_list, run_objects):
+            i_direct_beam += 1
+
+            logs = _log_values(run_object, DATA_RUN_LOGS)
+            theta = logs["two_theta"] * TWO_THETA_DEG_TO_THETA_RAD
+            data_scaling.append((theta, _quicknxs_scaling_factor_from_logs(logs, theta=theta)))
+            peak_min, peak_max = logs["scatt_peak_min"], logs["scatt_peak_max"]
+            bg_min, bg_max = logs["scatt_bg_min"], logs["scatt_bg_max"]
+            low_res_min, low_res_max = logs["scatt_low_res_min"], logs["scatt_low_res_max"]
+            dpix = run_object.getProperty("DIRPIX").getStatistics().mean
+            # For live data, we might not have a file name
+            if "Filename" in run_object:
+                filename = _legacy_filename(run_object.getProperty("Filename").value)
             else:
-                _clean_dict[key] = "%8g" % item[key]
-        fd.write(template.format(**_clean_dict))
-
-        x = ws.readX(0)
-        y = ws.readY(0)
-        dy = ws.readE(0)
-        dx = ws.readDx(0)
-        tth = ws.getRun().getProperty("two_theta").value * math.pi / 360.0
-        quicknxs_scale = quicknxs_scaling_factor(ws)
-        for i in range(len(x)):
-            data_block += "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n" % (
-                x[i],
-                y[i] * quicknxs_scale,
-                dy[i] * quicknxs_scale,
-                dx[i],
-                tth,
+                filename = "live data"
+            constant_q_binning = logs["constant_q_binning"]
+            scatt_pos = logs["specular_pixel"]
+            # norm_x_min = run_object.getProperty("norm_peak_min").value
+            # norm_x_max = run_object.getProperty("norm_peak_max").value
+            # norm_y_min = run_object.getProperty("norm_low_res_min").value
+            # norm_y_max = run_object.getProperty("norm_low_res_max").value
+
+            # For some reason, the tth value that QuickNXS expects is offset.
+            # It seems to be because that same offset is applied later in the QuickNXS calculation.
+            # Correct tth here so that it can load properly in QuickNXS and produce the same result.
+            tth = logs["two_theta"]
+            sample_det_dis = run_object["SampleDetDis"]
+            det_distance = sample_det_dis.getStatistics().mean
+            # Check units
+            if sample_det_dis.units not in ("m", "meter"):
+                det_distance /= 1000.0
+            direct_beam_pix = dpix
+
+            pixel_width = _pixel_width(ws.getInstrument())
+            tth -= (direct_beam_pix - scatt_pos) * pixel_width / det_distance * RAD_TO_DEG
+
+            # values in the order of DATASET_OPTIONS
+            row = (
+                1,  # scale
+                0,  # P0
+                0,  # PN
+                scatt_pos,  # x_pos
+                peak_max - peak_min + 1,  # x_width
+                (low_res_max + low_res_min) / 2.0,  # y_pos
+                low_res_max - low_res_min + 1,  # y_width
+                (bg_min + bg_max) / 2.0,  # bg_pos
+                bg_max - bg_min + 1,  # bg_width
+                constant_q_binning,  # fan
+                dpix,  # dpix
+                tth,  # tth
+                str(ws.getRunNumber()),  # number
+                i_direct_beam,  # DB_ID
+                filename,  # File
+            )
+            rows.append(DATASET_ROW_FORMAT % row)
+        fd.writelines(rows)
+
+        # Global options and sequence, taken from the last workspace
+        # TODO: set the sample dimension as an option
+        sequence = [
+            "# %s %s\n" % (name, run_object.getProperty(name).value[0])
+            for name in ("sequence_id", "sequence_number", "sequence_total")
+            if run_object.hasProperty(name)
+        ]
+        fd.write(
+            "".join(
+                ["#\n", "# [Global Options]\n", "# name           value\n", "# sample_length  10\n"]
+                + ["#\n", "# [Sequence]\n"]
+                + sequence
+                + ["#\n", "# [Data]\n", DATA_HEADER, "#\n"]
             )
+        )
 
-    fd.write("#\n")
-    fd.write("# [Global Options]\n")
-    fd.write("# name           value\n")
-    # TODO: set the sample dimension as an option
-    fd.write("# sample_length  10\n")
-    fd.write("#\n")
-    fd.write("# [Sequence]\n")
-    if run_object.hasProperty("sequence_id"):
-        fd.write("# sequence_id %s\n" % run_object.getProperty("sequence_id").value[0])
-    if run_object.hasProperty("sequence_number"):
-        fd.write("# sequence_number %s\n" % run_object.getProperty("sequence_number").value[0])
-    if run_object.hasProperty("sequence_total"):
-        fd.write("# sequence_total %s\n" % run_object.getProperty("sequence_total").value[0])
-    fd.write("#\n")
-    fd.write("# [Data]\n")
-    toks = ["%12s" % item for item in ["Qz [1/A]", "R [a.u.]", "dR [a.u.]", "dQz [1/A]", "theta [rad]"]]
-    fd.write("# %s\n" % "  ".join(toks))
-    fd.write("#\n%s\n" % data_block)
-
-    fd.close()
+        # Reflectivity data, written one workspace at a time
+        for ws, (theta, quicknxs_scale) in zip(ws_list, data_scaling):
+            x = ws.readX(0)
+            data = np.empty((len(x), 5))
+            data[:, 0] = x
+            np.multiply(ws.readY(0), quicknxs_scale, out=data[:, 1])
+            np.multiply(ws.readE(0), quicknxs_scale, out=data[:, 2])
+            data[:, 3] = ws.readDx(0)
+            data[:, 4] = theta  # broadcast, no temporary column
+            np.savetxt(fd, data, fmt=DATA_ROW_FORMAT)
+        fd.write("\n")
 
 
 def quicknxs_scaling_factor(ws) -> float:
     """FOR COMPATIBILITY WITH QUICKNXS"""
-    run_object = ws.getRun()
-    peak_min = run_object.getProperty("scatt_peak_min").value
-    peak_max = run_object.getProperty("scatt_peak_max").value + 1.0
-    low_res_min = run_object.getProperty("scatt_low_res_min").value
-    low_res_max = run_object.getProperty("scatt_low_res_max").value + 1.0
-    norm_x_min = run_object.getProperty("norm_peak_min").value
-    norm_x_max = run_object.getProperty("norm_peak_max").value + 1.0
-    norm_y_min = run_object.getProperty("norm_low_res_min").value
-    norm_y_max = run_object.getProperty("norm_low_res_max").value + 1.0
-    tth = run_object.getProperty("two_theta").value * math.pi / 360.0
-    quicknxs_scale = (float(norm_x_max) - float(norm_x_min)) * (float(norm_y_max) - float(norm_y_min))
-    quicknxs_scale /= (float(peak_max) - float(peak_min)) * (float(low_res_max) - float(low_res_min))
+    return _quicknxs_scaling_factor_from_logs(_log_values(ws.getRun(), QUICKNXS_SCALING_LOGS))
+
+
+def _quicknxs_scaling_factor_from_logs(logs, theta=None) -> float:
+    r"""QuickNXS scaling factor from the values of the sample logs of a reduced workspace.
+
+    Parameters
+    ----------
+    logs: dict
+        Values of the sample logs (at least those in `QUICKNXS_SCALING_LOGS`) keyed by log name,
+        as returned by `_log_values`
+    theta: Optional[float]
+        Scattering angle in radians, if already computed from log `two_theta`
+    """
+    peak_min = logs["scatt_peak_min"]
+    peak_max = logs["scatt_peak_max"] + 1.0
+    low_res_min = logs["scatt_low_res_min"]
+    low_res_max = logs["scatt_low_res_max"] + 1.0
+    norm_x_min = logs["norm_peak_min"]
+    norm_x_max = logs["norm_peak_max"] + 1.0
+    norm_y_min = logs["norm_low_res_min"]
+    norm_y_max = logs["norm_low_res_max"] + 1.0
+    tth = logs["two_theta"] * TWO_THETA_DEG_TO_THETA_RAD if theta is None else theta
+    quicknxs_scale = (norm_x_max - norm_x_min) * (norm_y_max - norm_y_min)
+    quicknxs_scale /= (peak_max - peak_min) * (low_res_max - low_res_min)
     _scale = 0.005 / math.sin(tth) if tth > 0.0002 else 1.0
     quicknxs_scale *= _scale
     return quicknxs_scale
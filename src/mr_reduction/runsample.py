@@ -9,6 +9,13 @@ from mantid.simpleapi import AddSampleLog, mtd
 SAMPLE_NUMBER_LOG = "sample_number"
 
 
+def _workspace_handle(input_workspace: Union[str, Workspace]) -> Workspace:
+    r"""Handle to a Mantid workspace, looked up in the analysis data service only when given a name"""
+    if isinstance(input_workspace, Workspace):
+        return input_workspace
+    return mtd[str(input_workspace)]
+
+
 class RunSampleNumber:
     r"""An extension of the run number when the run contains more than one sample
 
@@ -25,6 +32,8 @@ class RunSampleNumber:
         a number identifying the sample, beginning at 1
     """
 
+    __slots__ = ("_run_number", "_sample_number")
+
     @staticmethod
     def sample_number_log(input_workspace: Union[str, Workspace]) -> Optional[int]:
         r"""
@@ -39,7 +48,7 @@ class RunSampleNumber:
         -------
         Sample number, or `None` if no sample number is found in the logs
         """
-        workspace = mtd[str(input_workspace)]
+        workspace = _workspace_handle(input_workspace)
         if isinstance(workspace, WorkspaceGroup):
             workspace = workspace[0]
         run = workspace.getRun()
@@ -66,10 +75,12 @@ class RunSampleNumber:
         if isinstance(runsample, int):  # runsample represents a run number
             self._run_number = runsample
         elif isinstance(runsample, str):
-            if "_" in runsample:  # runsample represents a RunSampleNumber
-                self._run_number, self._sample_number = [int(x) for x in runsample.split("_")]
-            else:  # runsample represents a run number
-                self._run_number = int(runsample)
+            run_number, separator, sample = runsample.partition("_")
+            self._run_number = int(run_number)
+            if separator:  # runsample represents a RunSampleNumber
+                if "_" in sample:  # int() would accept "2_3" as 23
+                    raise ValueError(f"{runsample} is not a valid run-sample number")
+                self._sample_number = int(sample)
         elif isinstance(runsample, RunSampleNumber):  # runsample is a RunSampleNumber instance
             self._run_number = runsample._run_number
             self._sample_number = runsample._sample_number
@@ -114,7 +125,7 @@ class RunSampleNumber:
         """
         if self._sample_number is None:
             raise ValueError("Sample number cannot be None")
-        workspace = mtd[str(input_workspace)]  # handle to the workspace
+        workspace = _workspace_handle(input_workspace)
         if isinstance(workspace, WorkspaceGroup):
             for ws in workspace:
                 self.log_sample_number(ws)
@@ -1,6 +1,10 @@
 # standard imports
+import io
 import os
+import re
+import shutil
 import time
+from typing import List, Optional
 
 # third-party imports
 import mantid
@@ -11,6 +15,70 @@ from mr_reduction.reflectivity_output import quicknxs_scaling_factor
 from mr_reduction.runsample import RunSampleNumber
 from mr_reduction.settings import ar_out_dir
 
+# Header of the combined reduction scripts, formatted with the date when the script is written
+SCRIPT_HEADER = (
+    "# Mantid version " + mantid.__version__ + "\n"
+    "# Date: %s\n\n"
+    "from mantid.simpleapi import *\n\n"
+    "# Dictionary of workspace names. Each entry is a list of cross-sections\n"
+    "workspaces =  dict()\n"
+)
+TUNABLE_SCRIPT_HEADER = SCRIPT_HEADER + "parameters = dict()\n\n"
+
+# Names renamed in the prepare_*() function of a split script, see `generate_split_script`
+SPLIT_SCRIPT_RENAME_REGEX = re.compile(r"MagnetismReflectometryReduction|wsg")
+
+
+# Directories found to exist by `_search_dirs`. Directories not found are not cached, since they may be created later
+_existing_dirs = set()
+
+
+def _search_dirs(ipts: str, extra_search_dir: Optional[str] = None) -> List[str]:
+    r"""Directories where to find the autoreduced files of an experiment, such as the reflectivity profiles
+    and the partial reduction scripts.
+
+    Parameters
+    ----------
+    ipts: str
+        Experiment identifier (e.g. 'IPTS-42666')
+    extra_search_dir: Optional[str]
+        Directory to search first, if it exists
+
+    Returns
+    -------
+    List[str]
+        `extra_search_dir` (if it exists) and the canonical autoreduce directory /SNS/REF_M/IPTS-XXXX/shared/autoreduce
+    """
+    search_dirs = list()
+    if extra_search_dir is not None:
+        if extra_search_dir not in _existing_dirs and os.path.isdir(extra_search_dir):
+            _existing_dirs.add(extra_search_dir)
+        if extra_search_dir in _existing_dirs:
+            search_dirs.append(extra_search_dir)
+    if ar_out_dir(ipts) not in search_dirs:
+        search_dirs.append(ar_out_dir(ipts))
+    return search_dirs
+
+
+def _find_partial_scripts(matched_runs, search_dirs) -> dict:
+    r"""File paths of the partial reduction scripts of the matched runs, keyed by run (as `str`).
+
+    Each search directory is listed once, instead of checking for each run's script in each directory.
+    Scripts found in the first search directories take precedence.
+    """
+    filenames = {f"REF_M_{runsample}_partial.py": str(runsample) for runsample in matched_runs}
+    file_paths = dict()
+    for search_dir in search_dirs:
+        try:
+            with os.scandir(search_dir) as entries:
+                for entry in entries:
+                    runsample = filenames.get(entry.name)
+                    if runsample is not None and runsample not in file_paths and entry.is_file():
+                        file_paths[runsample] = entry.path
+        except OSError:  # e.g. the directory does not exist
+            continue
+    return file_paths
+
 
 def write_reduction_script(matched_runs, scaling_factors, ipts, output_dir=None, extra_search_dir=None) -> str:
     r"""Write a combined reduction script by pasting together the reduction script for each run that
@@ -36,33 +104,23 @@ def write_reduction_script(matched_runs, scaling_factors, ipts, output_dir=None,
     str
         File path of the combined reduction script (its file name is f"REF_M_{matched_runs[0]}_combined.py")
     """
-    script = "# Mantid version %s\n" % mantid.__version__
-    script += "# Date: %s\n\n" % time.strftime("%Y-%m-%d %H:%M:%S")
-    script += "from mantid.simpleapi import *\n\n"
-    script += "# Dictionary of workspace names. Each entry is a list of cross-sections\n"
-    script += "workspaces =  dict()\n"
-
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
-
-    for i, runsample in enumerate(matched_runs):
-        for search_dir in search_dirs:
-            file_path = os.path.join(search_dir, "REF_M_%s_partial.py" % runsample)
-            if os.path.isfile(file_path):
-                with open(file_path, "r") as _fd:
-                    script += "# Run:%s\n" % runsample
-                    script += "scaling_factor = %s\n" % scaling_factors[i]
-                    script += _fd.read() + "\n"
-                break  # no need to search in the other search directory
+    search_dirs = _search_dirs(ipts, extra_search_dir)
 
     script_filename = f"REF_M_{matched_runs[0]}_combined.py"
     if output_dir is None or os.path.isdir(output_dir) is False:
         output_dir = ar_out_dir(ipts)
     with open(os.path.join(output_dir, script_filename), "w") as fd:
-        fd.write(script)
+        fd.write(SCRIPT_HEADER % time.strftime("%Y-%m-%d %H:%M:%S"))
+        # Copy the partial script of each run straight into the combined script
+        partial_scripts = _find_partial_scripts(matched_runs, search_dirs)
+        for runsample, scaling_factor in zip(matched_runs, scaling_factors, strict=True):
+            file_path = partial_scripts.get(str(runsample))
+            if file_path is None:
+                continue
+            with open(file_path, "r") as _fd:
+                fd.write("# Run:%s\nscaling_factor = %s\n" % (runsample, scaling_factor))
+                shutil.copyfileobj(_fd, fd)
+                fd.write("\n")
     return script_filename
 
 
@@ -90,40 +148,35 @@ def write_tunable_reduction_script(matched_runs, scaling_factors, ipts, output_d
     str
         File path of the combined reduction script (its file name is f"REF_M_{matched_runs[0]}_tunable_combined.py"")
     """
-    script = "# Mantid version %s\n" % mantid.__version__
-    script += "# Date: %s\n\n" % time.strftime("%Y-%m-%d %H:%M:%S")
-    script += "from mantid.simpleapi import *\n\n"
-    script += "# Dictionary of workspace names. Each entry is a list of cross-sections\n"
-    script += "workspaces =  dict()\n"
-    script += "parameters = dict()\n\n"
-
-    search_dirs = list()
-    if extra_search_dir is not None and os.path.isdir(extra_search_dir):
-        search_dirs.append(extra_search_dir)
-    if ar_out_dir(ipts) not in search_dirs:
-        search_dirs.append(ar_out_dir(ipts))
+    script = io.StringIO()
+    script.write(TUNABLE_SCRIPT_HEADER % time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    search_dirs = _search_dirs(ipts, extra_search_dir)
+
+    # note: io.StringIO(initial_value) would leave the position at 0, and the next write would overwrite it
+    reduce_call = io.StringIO()
+    reduce_call.write("\ndef reduce():\n")
+    prepare_call = io.StringIO()
+    prepare_call.write("def prepare():\n")
+    partial_scripts = _find_partial_scripts(matched_runs, search_dirs)
+    for runsample, scaling_factor in zip(matched_runs, scaling_factors, strict=True):
+        file_path = partial_scripts.get(str(runsample))
+        if file_path is None:
+            continue
+        script.write("\n# Run:%s\n" % runsample)
+        script.write("parameters['r_%s'] = dict(sf_%s = %s)\n" % (runsample, runsample, scaling_factor))
+        script.write(generate_split_script(runsample, file_path))
+        script.write("\n")
+        reduce_call.write("    reduce_%s()\n" % runsample)
+        prepare_call.write("    prepare_%s()\n" % runsample)
 
-    reduce_call = "\ndef reduce():\n"
-    prepare_call = "def prepare():\n"
-    for i, runsample in enumerate(matched_runs):
-        for search_dir in search_dirs:
-            file_path = os.path.join(search_dir, "REF_M_%s_partial.py" % runsample)
-            if os.path.isfile(file_path):
-                script += "\n# Run:%s\n" % runsample
-                script += "parameters['r_%s'] = dict(sf_%s = %s)\n" % (runsample, runsample, scaling_factors[i])
-                _script = generate_split_script(runsample, file_path)
-                script += _script + "\n"
-                reduce_call += "    reduce_%s()\n" % runsample
-                prepare_call += "    prepare_%s()\n" % runsample
-                break  # no need to search in the other search directory
-
-    script += prepare_call
-    script += reduce_call
     if output_dir is None or os.path.isdir(output_dir) is False:
         output_dir = ar_out_dir(ipts)
     script_filepath = os.path.join(output_dir, f"REF_M_{matched_runs[0]}_tunable_combined.py")
     with open(script_filepath, "w") as fd:
-        fd.write(script)
+        fd.write(script.getvalue())
+        fd.write(prepare_call.getvalue())
+        fd.write(reduce_call.getvalue())
     return script_filepath
 
 
@@ -191,22 +244,21 @@ def generate_script_from_ws(ws_grp, group_name):
         return "# No workspace was generated\n"
 
     xs_list = [str(_ws) for _ws in ws_grp if not str(_ws).endswith("unfiltered")]
-    script = "workspaces['%s'] = %s\n" % (group_name, str(xs_list))
-
-    script_text = api.GeneratePythonScript(ws_grp[0])
-    # Skip the header
-    lines = script_text.split("\n")
-    script_text = "\n".join(lines[4:])
-    script += script_text.replace(", ", ",\n                                ")
-    script += "\n"
+    script = ["workspaces['%s'] = %s\n" % (group_name, str(xs_list))]
+
+    # Skip the four header lines, splitting off only those instead of every line of the script
+    script_text = api.GeneratePythonScript(ws_grp[0]).split("\n", 4)
+    script_text = script_text[4] if len(script_text) == 5 else ""
+    script.append(script_text.replace(", ", ",\n                                "))
+    script.append("\n")
     qnxs_scale = quicknxs_scaling_factor(ws_grp[0])
     # Scale correction for QuickNXS compatibility
-    script += "scaling_factor *= %s\n" % qnxs_scale
+    script.append("scaling_factor *= %s\n" % qnxs_scale)
     for item in xs_list:
-        script += "Scale(InputWorkspace='%s', Operation='Multiply',\n" % str(item)
-        script += "      Factor=scaling_factor, OutputWorkspace='%s')\n\n" % str(item)
+        script.append("Scale(InputWorkspace='%s', Operation='Multiply',\n" % item)
+        script.append("      Factor=scaling_factor, OutputWorkspace='%s')\n\n" % item)
 
-    return script
+    return "".join(script)
 
 
 def generate_split_script(run_sample_number, partial_script_path) -> str:
@@ -229,42 +281,42 @@ def generate_split_script(run_sample_number, partial_script_path) -> str:
     str
         Contents of the reduction script
     """
-    red_script = "def prepare_%s():\n" % run_sample_number
-    scale_script = ""
+    red_script = ["def prepare_%s():\n" % run_sample_number]
+    scale_script = []
+    scaling_factor = 'parameters["r_%s"]["sf_%s"]' % (run_sample_number, run_sample_number)
 
     with open(partial_script_path, "r") as fd:
-        _script_started = False
-        _scale_started = False
+        _script_started = False  # inside the call to MagnetismReflectometryReduction
+        _scale_started = False  # past the first call to Scale
         _first_line = True
-        for line in fd.readlines():
-            if line.startswith("MagnetismReflectometryRed"):
-                _script_started = True
-            elif line.startswith("Scale"):
-                _scale_started = True
-
-            if _script_started:
+        for line in fd:
+            # Lines inside the call are only checked for the end of the call
+            if _script_started or line.startswith("MagnetismReflectometryRed"):
                 if _first_line:
-                    red_script += "    " + line
+                    red_script.append("    " + line)
                     _first_line = False
                 else:
-                    red_script += "                        " + line.strip() + "\n"
-                if line.endswith(")\n"):
-                    _script_started = False
-            elif _scale_started:
-                scale_script += "    " + line.replace(
-                    "scaling_factor", 'parameters["r_%s"]["sf_%s"]' % (run_sample_number, run_sample_number)
-                )
+                    red_script.append("                        " + line.strip() + "\n")
+                _script_started = not line.endswith(")\n")
+            elif _scale_started or line.startswith("Scale"):
+                _scale_started = True
+                scale_script.append("    " + line.replace("scaling_factor", scaling_factor))
             else:
-                red_script += "    " + line.replace(
-                    "scaling_factor", 'parameters["r_%s"]["sf_%s"]' % (run_sample_number, run_sample_number)
-                )
-
-    red_script = red_script.replace("MagnetismReflectometryReduction", "params_%s = dict" % run_sample_number)
-    red_script = red_script.replace("wsg", "wsg_%s" % run_sample_number)
-    red_script += '    parameters["r_%s"]["params"] = params_%s\n' % (run_sample_number, run_sample_number)
-
-    red_script += "\ndef reduce_%s():\n" % run_sample_number
-    red_script += '    MagnetismReflectometryReduction(**parameters["r_%s"]["params"])\n' % run_sample_number
-    red_script += scale_script
-
-    return red_script
+                red_script.append("    " + line.replace("scaling_factor", scaling_factor))
+
+    # Rename in one pass, same as renaming one after the other since run-sample numbers never contain "wsg"
+    renames = {
+        "MagnetismReflectometryReduction": "params_%s = dict" % run_sample_number,
+        "wsg": "wsg_%s" % run_sample_number,
+    }
+    red_script = SPLIT_SCRIPT_RENAME_REGEX.sub(lambda match: renames[match.group(0)], "".join(red_script))
+
+    return "".join(
+        [
+            red_script,
+            '    parameters["r_%s"]["params"] = params_%s\n' % (run_sample_number, run_sample_number),
+            "\ndef reduce_%s():\n" % run_sample_number,
+            '    MagnetismReflectometryReduction(**parameters["r_%s"]["params"])\n' % run_sample_number,
+        ]
+        + scale_script
+    )
@@ -1,3 +1,6 @@
+# standard imports
+from unittest import mock
+
 # third party imports
 import numpy as np
 import pytest
@@ -6,6 +9,7 @@ from mantid.simpleapi import LoadEventNexus
 # mr_reduction imports
 from mr_reduction.data_info import Fitter
 from mr_reduction.logging import logger
+from mr_reduction.mr_reduction import ReductionProcess
 
 
 class TestFindPeaks:
@@ -24,5 +28,48 @@ class TestFindPeaks:
         assert center_x < 174
 
 
+class TestReductionProcess:
+    @pytest.mark.parametrize(
+        ("data_run", "data_ws", "run_number", "file_path", "logged"),
+        [
+            (29160, None, 29160, "REF_M_29160", False),
+            (np.int64(29160), None, 29160, "REF_M_29160", False),
+            ("29160", None, 29160, "REF_M_29160", False),
+            ("/tmp/REF_M_29160.nxs.h5", None, None, "/tmp/REF_M_29160.nxs.h5", False),
+            ("29160\u00b2", None, None, "29160\u00b2", False),  # "²" is a digit but not a decimal character
+            (None, mock.sentinel.events, None, None, False),  # live reduction passes the events workspace
+            (None, None, None, None, True),
+        ],
+    )
+    def test_init_data_run(self, data_run, data_ws, run_number, file_path, logged):
+        with mock.patch("mr_reduction.mr_reduction.logger") as mock_logger:
+            processor = ReductionProcess(data_run=data_run, data_ws=data_ws, publish=False)
+        assert processor.run_number == run_number
+        assert processor.file_path == file_path
+        assert processor.data_ws is data_ws
+        assert mock_logger.error.called == logged
+
+    @pytest.mark.parametrize(
+        ("data_ws", "filename"),
+        [
+            (None, "REF_M_29160"),  # events loaded from the file
+            (mock.Mock(**{"getRunNumber.return_value": 29160}), None),  # events passed in, e.g. live reduction
+        ],
+    )
+    def test_filter_cross_sections_input(self, data_ws, filename):
+        processor = ReductionProcess(data_run="29160", data_ws=data_ws, publish=False)
+        with (
+            mock.patch("mr_reduction.mr_reduction.LoadEventNexus") as mock_load,
+            mock.patch("mr_reduction.mr_reduction.MRFilterCrossSections", side_effect=RuntimeError) as mock_filter,
+        ):
+            mock_load.return_value.getRunNumber.return_value = 29160
+            with pytest.raises(RuntimeError):
+                processor.reduce()
+        assert mock_load.called == (data_ws is None)
+        assert mock_filter.call_args.kwargs["Filename"] == filename
+        assert mock_filter.call_args.kwargs["InputWorkspace"] is processor.data_ws
+        assert mock_filter.call_args.kwargs["CrossSectionWorkspaces"] == "29160"
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,321 @@
+# standard imports
+import json
+import os
+from unittest import mock
+
+# third party imports
+import numpy as np
+import pytest
+
+# mr_reduction imports
+from mr_reduction.reflectivity_merge import (
+    AUTOREDUCE_FILE_REGEX,
+    _build_autoreduce_index,
+    _extract_sequence_id,
+    _format_reflectivity,
+    _parse_autoreduce,
+    _stitch_scale,
+    apply_scaling_factors,
+    combined_catalog_info,
+    compute_scaling_factors,
+    match_run_for_cross_section,
+    select_cross_section,
+)
+from mr_reduction.reflectivity_output import DATASET_OPTIONS, DIRECT_BEAM_OPTIONS, write_reflectivity
+from mr_reduction.runsample import RunSampleNumber
+from mr_reduction.script_output import _find_partial_scripts, _search_dirs
+
+
+class TestStitchScale:
+    def test_stitch_scale(self):
+        q1 = np.linspace(0.01, 0.05, 41)
+        r1 = 1.0 / q1
+        q2 = np.linspace(0.04, 0.10, 61)
+        r2 = 0.25 / q2
+        scale = _stitch_scale(q1, r1, q2, r2)
+        assert scale == pytest.approx(4.0)
+
+    def test_noisy_overlap(self):
+        # histogram edges are [0.5, 1.5, 2.5, 3.5, 4.5] and [2.5, 3.5, 4.5, 5.5, 6.5], overlapping in [2.5, 4.5]
+        q1, r1 = np.array([1.0, 2.0, 3.0, 4.0]), np.array([10.0, 8.0, 6.3, 3.9])
+        q2, r2 = np.array([3.0, 4.0, 5.0, 6.0]), np.array([3.0, 2.1, 1.0, 0.5])
+        assert _stitch_scale(q1, r1, q2, r2) == pytest.approx((6.3 + 3.9) / (3.0 + 2.1))
+
+    def test_partial_bins(self):
+        # histogram edges of the second profile are [2.7, 3.7, 4.7, 5.7], thus the overlap is [2.7, 4.5]
+        q1, r1 = np.array([1.0, 2.0, 3.0, 4.0]), np.array([10.0, 8.0, 6.3, 3.9])
+        q2, r2 = np.array([3.2, 4.2, 5.2]), np.array([3.0, 2.1, 1.0])
+        expected = (0.8 * 6.3 + 3.9) / (3.0 + 0.8 * 2.1)
+        assert _stitch_scale(q1, r1, q2, r2) == pytest.approx(expected)
+
+    def test_no_overlap(self):
+        q1, q2 = np.linspace(0.01, 0.05, 5), np.linspace(0.07, 0.11, 5)
+        ones = np.ones(5)
+        with pytest.raises(ValueError, match="don't overlap"):
+            _stitch_scale(q1, ones, q2, ones)
+
+
+class TestParseAutoreduce:
+    def test_values_round_trip(self, tmp_path):
+        # values with six significant digits that single precision would not reproduce
+        rows = "".join(
+            "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n"
+            % (0.0200251 + i * 1.0e-7, 0.987654 - i * 1.0e-6, 0.0123457, 1.0e-4, 0.0123)
+            for i in range(50)
+        )
+        file_path = tmp_path / "REF_M_1234_Off_Off_autoreduce.dat"
+        file_path.write_text("# [Data]\n" + rows)
+        data = _parse_autoreduce(str(file_path)).data
+        assert data.dtype == np.float64
+        assert _format_reflectivity(*data.T) == rows
+
+    def test_rewritten_file(self, tmp_path):
+        file_path = tmp_path / "REF_M_1234_Off_Off_autoreduce.dat"
+        file_path.write_text("# [Data]\n0.01 1.0 0.1 0.001 0.01\n")
+        mtime_ns = file_path.stat().st_mtime_ns
+        assert _parse_autoreduce(str(file_path)).data[0, 1] == 1.0
+        # rewrite the file within the same timestamp, as can happen on filesystems with a coarse time resolution
+        file_path.write_text("# [Data]\n0.01 2.0 0.1 0.001 0.01\n0.02 3.0 0.1 0.001 0.01\n")
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+        np.testing.assert_equal(_parse_autoreduce(str(file_path)).data[:, 1], [2.0, 3.0])
+
+    def test_header_only(self, tmp_path):
+        file_path = tmp_path / "REF_M_1234_Off_Off_autoreduce.dat"
+        file_path.write_text("# Experiment IPTS-1 Run 1234\n# [Data]\n\n  \n")
+        header, data = _parse_autoreduce(str(file_path))
+        assert header == ("# Experiment IPTS-1 Run 1234\n", "# [Data]\n")
+        assert data.shape == (0, 5)
+
+
+def write_autoreduce(directory, runsample, cross_section, data, header=""):
+    r"""Write an autoreduced reflectivity profile with rows of `data`, returning its file path"""
+    file_path = directory / f"REF_M_{runsample}_{cross_section}_autoreduce.dat"
+    rows = "".join("%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n" % tuple(row) for row in data)
+    file_path.write_text(header + "# [Data]\n" + rows + "\n")
+    return str(file_path)
+
+
+class TestApplyScalingFactors:
+    def test_rescale_in_double_precision(self, tmp_path):
+        rng = np.random.default_rng(42)
+        profiles = dict()
+        for i, runsample in enumerate(["1234", "1235"]):
+            q = np.linspace(0.01, 0.05, 30) * (i + 1)
+            r = rng.uniform(0.001, 1.0, 30)
+            data = np.column_stack([q, r, 0.05 * r, 0.001 * q, np.full_like(q, 0.01)])
+            for xs in ["Off_Off", "On_Off"]:
+                write_autoreduce(tmp_path, runsample, xs, data)
+            profiles[runsample] = np.loadtxt(tmp_path / f"REF_M_{runsample}_On_Off_autoreduce.dat")
+        scaling_factors = [1.0, 0.123456789]
+        index = _build_autoreduce_index([str(tmp_path)])
+        buffers = dict(
+            apply_scaling_factors(["1234", "1235"], "IPTS-1", "Off_Off", scaling_factors, autoreduce_index=index)
+        )
+        expected = "".join(
+            "%12.6g  %12.6g  %12.6g  %12.6g  %12.6g\n" % (q, factor * r, factor * dr, dq, a)
+            for runsample, factor in zip(["1234", "1235"], scaling_factors)
+            for q, r, dr, dq, a in profiles[runsample]
+        )
+        assert buffers["On_Off"] == expected
+        assert buffers["Off_On"] == ""
+
+    def test_mismatched_scaling_factors(self, tmp_path):
+        q = np.linspace(0.01, 0.05, 10)
+        write_autoreduce(tmp_path, "1234", "On_Off", np.column_stack([q, 1 / q, 0.1 / q, 0.001 * q, 0.01 * q]))
+        index = _build_autoreduce_index([str(tmp_path)])
+        with pytest.raises(ValueError, match="zip()"):
+            apply_scaling_factors(["1234", "1235"], "IPTS-1", "Off_Off", [1.0], autoreduce_index=index)
+
+
+class TestMatchRunForCrossSection:
+    def test_skip_header_only(self, tmp_path):
+        q = np.linspace(0.01, 0.05, 10)
+        write_autoreduce(tmp_path, "1234", "Off_Off", np.column_stack([q, 1 / q, 0.1 / q, 0.001 * q, 0.01 * q]))
+        write_autoreduce(tmp_path, "1235", "Off_Off", [])
+        index = _build_autoreduce_index([str(tmp_path)])
+        assert match_run_for_cross_section("1235", "IPTS-1", "Off_Off", autoreduce_index=index) == ["1234"]
+
+
+class TestSelectCrossSection:
+    def test_skip_vanishing_profiles(self, tmp_path):
+        q = np.linspace(0.01, 0.05, 10)
+        write_autoreduce(tmp_path, "1234", "Off_Off", [])
+        write_autoreduce(tmp_path, "1234", "On_Off", np.column_stack([q, 0 * q, 0 * q, 0.001 * q, 0.01 * q]))
+        write_autoreduce(tmp_path, "1234", "Off_On", np.column_stack([q, 1 / q, 0.2 / q, 0.001 * q, 0.01 * q]))
+        write_autoreduce(tmp_path, "1234", "On_On", np.column_stack([q, 1 / q, 0.1 / q, 0.001 * q, 0.01 * q]))
+        index = _build_autoreduce_index([str(tmp_path)])
+        assert select_cross_section("1234", "IPTS-1", autoreduce_index=index) == "On_On"
+
+
+class TestAutoreduceIndex:
+    @pytest.mark.parametrize(
+        ("filename", "groups"),
+        [
+            ("REF_M_1234_Off_Off_autoreduce.dat", ("1234", "Off_Off")),
+            ("REF_M_1234_2_On_On_autoreduce.dat", ("1234_2", "On_On")),
+            ("REF_M_1234_Off_Off_combined.dat", None),
+            ("REF_M_1234_On_Off_autoreduce.dat.bak", None),
+            ("REF_M_1234_Up_Up_autoreduce.dat", None),
+            ("REF_M_1234_2_3_Off_Off_autoreduce.dat", None),
+        ],
+    )
+    def test_file_regex(self, filename, groups):
+        match = AUTOREDUCE_FILE_REGEX.match(filename)
+        assert (match.groups() if match else None) == groups
+
+    def test_search_dirs(self, tmp_path):
+        canonical_dir = str(tmp_path / "autoreduce")
+        with mock.patch("mr_reduction.script_output.ar_out_dir", return_value=canonical_dir):
+            assert _search_dirs("IPTS-1") == [canonical_dir]
+            assert _search_dirs("IPTS-1", str(tmp_path)) == [str(tmp_path), canonical_dir]
+            assert _search_dirs("IPTS-1", str(tmp_path / "missing")) == [canonical_dir]
+            assert _search_dirs("IPTS-1", canonical_dir) == [canonical_dir]
+
+    def test_build_autoreduce_index(self, tmp_path):
+        first_dir, second_dir = tmp_path / "first", tmp_path / "second"
+        first_dir.mkdir()
+        second_dir.mkdir()
+        for directory in (first_dir, second_dir):
+            write_autoreduce(directory, "1234", "Off_Off", [])
+        write_autoreduce(second_dir, "1235_2", "On_On", [])
+        (first_dir / "REF_M_1234_Off_Off_combined.dat").write_text("")
+        (first_dir / "REF_M_1234_partial.py").write_text("")
+        (first_dir / "REF_M_1236_Off_Off_autoreduce.dat").mkdir()  # not a file
+        index = _build_autoreduce_index([str(tmp_path / "missing"), str(first_dir), str(second_dir)])
+        assert index == {
+            ("1234", "Off_Off"): str(first_dir / "REF_M_1234_Off_Off_autoreduce.dat"),
+            ("1235_2", "On_On"): str(second_dir / "REF_M_1235_2_On_On_autoreduce.dat"),
+        }
+
+    def test_find_partial_scripts(self, tmp_path):
+        first_dir, second_dir = tmp_path / "first", tmp_path / "second"
+        first_dir.mkdir()
+        second_dir.mkdir()
+        for directory in (first_dir, second_dir):
+            (directory / "REF_M_1234_partial.py").write_text("")
+        (second_dir / "REF_M_1235_2_partial.py").write_text("")
+        (second_dir / "REF_M_1236_partial.py").write_text("")  # not a matched run
+        file_paths = _find_partial_scripts(
+            ["1234", "1235_2", "1237"], [str(tmp_path / "missing"), str(first_dir), str(second_dir)]
+        )
+        assert file_paths == {
+            "1234": str(first_dir / "REF_M_1234_partial.py"),
+            "1235_2": str(second_dir / "REF_M_1235_2_partial.py"),
+        }
+
+
+class TestExtractSequenceId:
+    def test_extract(self, tmp_path):
+        header = "# Input file indices: 1234_2\n# [Sequence]\n# sequence_id 1230\n# sequence_number 5\n"
+        file_path = write_autoreduce(tmp_path, "1234_2", "Off_Off", [[0.0123, 1.0, 0.1, 0.001, 0.01]], header=header)
+        assert _extract_sequence_id(file_path) == ("1234_2", 1230, pytest.approx(0.0123))
+
+    def test_missing_values(self, tmp_path):
+        header = "# Input file indices: 1234\n# sequence_id not-a-number\n"
+        file_path = write_autoreduce(tmp_path, "1234", "Off_Off", [], header=header)
+        assert _extract_sequence_id(file_path) == ("1234", None, None)
+        assert _extract_sequence_id(str(tmp_path / "REF_M_1235_Off_Off_autoreduce.dat")) == (None, None, None)
+        with pytest.raises(AssertionError):
+            _extract_sequence_id(str(tmp_path / "REF_M_1234_Off_Off_combined.dat"))
+
+
+def fake_workspace(run_number, q, normalization_run="None"):
+    r"""Mock of a reduced reflectivity workspace, with the sample logs read by `write_reflectivity`"""
+    logs = {
+        "normalization_run": normalization_run,
+        "norm_peak_min": 120,
+        "norm_peak_max": 140,
+        "norm_bg_min": 20,
+        "norm_bg_max": 40,
+        "norm_low_res_min": 50,
+        "norm_low_res_max": 200,
+        "normalization_dirpix": 130.5,
+        "normalization_file_path": "/SNS/REF_M/IPTS-1/nexus/REF_M_%s.nxs.h5" % normalization_run,
+        "scatt_peak_min": 150,
+        "scatt_peak_max": 165,
+        "scatt_bg_min": 10,
+        "scatt_bg_max": 30,
+        "scatt_low_res_min": 60,
+        "scatt_low_res_max": 190,
+        "constant_q_binning": False,
+        "specular_pixel": 157.25,
+        "two_theta": 1.2,
+        "Filename": "/SNS/REF_M/IPTS-1/nexus/REF_M_%d.nxs.h5" % run_number,
+        "sequence_id": [run_number],
+    }
+    properties = {name: mock.Mock(value=value) for name, value in logs.items()}
+    properties["DIRPIX"] = mock.Mock(**{"getStatistics.return_value.mean": 130.0})
+    properties["SampleDetDis"] = mock.Mock(units="m", **{"getStatistics.return_value.mean": 2.5})
+    run = mock.MagicMock()
+    run.getProperty.side_effect = properties.__getitem__
+    run.hasProperty.side_effect = properties.__contains__
+    run.__contains__.side_effect = properties.__contains__
+    run.__getitem__.side_effect = properties.__getitem__
+    workspace = mock.Mock()
+    workspace.getRun.return_value = run
+    workspace.getRunNumber.return_value = run_number
+    workspace.getInstrument.return_value.hasParameter.return_value = False
+    workspace.readX.return_value = q
+    workspace.readY.return_value = np.exp(-30 * q)
+    workspace.readE.return_value = 0.05 * np.exp(-30 * q)
+    workspace.readDx.return_value = 0.02 * q
+    return workspace
+
+
+class TestComputeScalingFactors:
+    def test_header_options(self, tmp_path):
+        # profiles of two runs written by the autoreduction, each with its own direct beam
+        workspaces = {
+            "1234": fake_workspace(1234, np.linspace(0.01, 0.03, 21), normalization_run="1200"),
+            "1235": fake_workspace(1235, np.linspace(0.02, 0.06, 41), normalization_run="1201"),
+        }
+        with mock.patch.object(RunSampleNumber, "sample_number_log", return_value=None):
+            for runsample, workspace in workspaces.items():
+                write_reflectivity([workspace], str(tmp_path / f"REF_M_{runsample}_Off_Off_autoreduce.dat"), "Off_Off")
+        index = _build_autoreduce_index([str(tmp_path)])
+        scaling_factors, direct_beam_info, data_info, data_buffer, xs_label = compute_scaling_factors(
+            ["1234", "1235"], "IPTS-1", "Off_Off", autoreduce_index=index
+        )
+        assert xs_label == "Off_Off"
+        assert len(scaling_factors) == 2
+        assert len(data_buffer.splitlines()) == 21 + 41
+
+        direct_beams = [dict(zip(DIRECT_BEAM_OPTIONS, line[1:].split())) for line in direct_beam_info.splitlines()]
+        assert [direct_beam["DB_ID"] for direct_beam in direct_beams] == ["1", "2"]
+        assert [direct_beam["number"] for direct_beam in direct_beams] == ["1200", "1201"]
+        assert direct_beams[0]["File"] == "/SNS/REF_M/IPTS-1/data/REF_M_1200_histo.nxs"
+        assert float(direct_beams[0]["x_pos"]) == 130.0
+        assert float(direct_beams[0]["y_width"]) == 151.0
+        assert float(direct_beams[0]["dpix"]) == 130.5
+
+        datasets = [dict(zip(DATASET_OPTIONS, line[1:].split())) for line in data_info.splitlines()]
+        assert [float(dataset["scale"]) for dataset in datasets] == pytest.approx(scaling_factors, rel=1e-5)
+        assert [dataset["number"] for dataset in datasets] == ["1234", "1235"]
+        assert [dataset["DB_ID"] for dataset in datasets] == ["1", "2"]
+        assert datasets[1]["File"] == "/SNS/REF_M/IPTS-1/data/REF_M_1235_histo.nxs"
+        assert float(datasets[0]["x_pos"]) == 157.25
+        assert float(datasets[0]["x_width"]) == 16.0
+        assert datasets[0]["fan"] == "0"
+
+
+class TestCombinedCatalogInfo:
+    def test_catalog_file(self, tmp_path):
+        (tmp_path / "REF_M_1234.nxs.h5").write_text("")
+        output_files = [str(tmp_path / "REF_M_1234_Off_Off_combined.dat")]
+        with mock.patch("mr_reduction.reflectivity_merge.nexus_data_dir", return_value=str(tmp_path)):
+            json_path = combined_catalog_info(["1234", "1235"], "IPTS-1", output_files, output_dir=str(tmp_path))
+        assert json_path == str(tmp_path / "REF_M_1234.json")
+        with open(json_path, "r") as fd:
+            contents = fd.read()
+        info = json.loads(contents)
+        assert contents == json.dumps(info, indent=4)  # same layout whatever JSON packages are installed
+        assert info["input_files"] == [
+            dict(location=str(tmp_path / "REF_M_1234.nxs.h5"), type="raw", purpose="sample-data")
+        ]
+        assert info["output_files"] == [
+            dict(location=output_files[0], type="processed", purpose="reduced-data", fields=dict())
+        ]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
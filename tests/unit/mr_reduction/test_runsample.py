@@ -20,6 +20,8 @@ class TestRunSampleNumber:
         assert str(runsample) == "1234_42"
         runsample2 = RunSampleNumber(runsample)
         assert str(runsample2) == "1234_42"
+        with pytest.raises(ValueError, match="not a valid run-sample number"):
+            RunSampleNumber("1234_42_1")
 
     def test_str(self):
         assert str(RunSampleNumber("1234")) == "1234"